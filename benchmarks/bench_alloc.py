@@ -0,0 +1,64 @@
+"""
+Heap allocated per inbound message by Agent._mqtt_callback.
+
+"legacy" replays the previous decode path (topic and payload decoded to
+str, topic rewritten, JSON parsed from the str); "current" is the bytes
+path with the raw-topic route cache. Uses gc.mem_alloc() deltas with the
+collector disabled on MicroPython and tracemalloc peaks on CPython.
+"""
+import gc
+import json
+
+from common import report
+
+from uagent import Agent
+
+N = 200
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def legacy_callback(agent, topic, msg):
+    mqtt_topic = topic.decode()
+    nats_topic = agent._from_mqtt_topic(mqtt_topic)
+    payload = json.loads(msg.decode())
+    agent._dispatch(nats_topic, payload)
+
+
+def bytes_per_message(func):
+    func()  # Warm the route cache
+    gc.collect()
+    if tracemalloc is None:
+        gc.disable()
+        start = gc.mem_alloc()
+        for _ in range(N):
+            func()
+        used = gc.mem_alloc() - start
+        gc.enable()
+        return used / N
+    tracemalloc.start()
+    peaks = 0
+    for _ in range(N):
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        func()
+        peaks += tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return peaks / N
+
+
+def main():
+    agent = Agent("bench", log_level="ERROR")
+    agent.on_event("fleet.*.telemetry")(lambda **kwargs: None)
+    topic = b"fleet/esp32-kitchen/telemetry"
+    msg = json.dumps({"readings": [21.5 + i for i in range(64)], "ok": True}).encode()
+    legacy = bytes_per_message(lambda: legacy_callback(agent, topic, msg))
+    current = bytes_per_message(lambda: agent._mqtt_callback(topic, msg))
+    report("alloc", msg_bytes=len(msg), legacy_b=int(legacy), current_b=int(current))
+
+
+if __name__ == "__main__":
+    main()
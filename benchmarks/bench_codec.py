@@ -0,0 +1,43 @@
+"""
+Encode/decode time and payload size of the JSON and binary codecs for
+typical telemetry payloads.
+"""
+from common import measure, report
+
+from uagent import BINARY, JSON
+
+N = 2000
+
+PAYLOADS = {
+    "reading": {"value": 21.5, "unit": "C"},
+    "telemetry": {
+        "agent": "esp32-kitchen",
+        "temp": 21.5,
+        "humidity": 48,
+        "pressure": 1013.25,
+        "battery": 3.71,
+        "rssi": -67,
+        "uptime": 864123,
+        "ok": True,
+    },
+    "samples": {"sensor": "accel", "x": [12, -3, 7, 0, 5, -1, 9, 2] * 4},
+}
+
+
+def main():
+    for name in sorted(PAYLOADS):
+        payload = PAYLOADS[name]
+        for codec_name, codec in (("json", JSON), ("binary", BINARY)):
+            data = codec.encode(payload)
+            report(
+                "codec",
+                payload=name,
+                codec=codec_name,
+                bytes=len(data),
+                encode_us=measure(lambda: codec.encode(payload), N),
+                decode_us=measure(lambda: codec.decode(data), N),
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Per-message dispatch cost of Agent._mqtt_callback as the number of
+registered on_event patterns grows. With the compiled topic index the
+cost should stay roughly flat from 10 to 10,000 patterns.
+"""
+from common import measure, report
+
+from uagent import Agent
+
+N = 2000
+
+
+def handler(**kwargs):
+    pass
+
+
+def build_agent(count):
+    agent = Agent("bench", log_level="ERROR")
+    for i in range(count):
+        if i % 10 == 0:
+            pattern = "fleet.%d.*.temp" % i
+        elif i % 10 == 1:
+            pattern = "fleet.%d.**" % i
+        else:
+            pattern = "fleet.%d.sensor.temp" % i
+        agent.on_event(pattern)(handler)
+    return agent
+
+
+def main():
+    payload = b'{"value": 21.5}'
+    for count in (10, 100, 1000, 10000):
+        agent = build_agent(count)
+        hit = b"fleet/2/sensor/temp"
+        miss = b"fleet/unknown/sensor/temp"
+        rotating = [b"fleet/%d/sensor/temp" % i for i in range(0, count, 7)]
+        state = [0]
+
+        def dispatch_rotating():
+            i = state[0]
+            state[0] = (i + 1) % len(rotating)
+            agent._mqtt_callback(rotating[i], payload)
+
+        report(
+            "dispatch",
+            patterns=count,
+            hit_us=measure(lambda: agent._mqtt_callback(hit, payload), N),
+            miss_us=measure(lambda: agent._mqtt_callback(miss, payload), N),
+            rotating_us=measure(dispatch_rotating, N),
+        )
+
+
+if __name__ == "__main__":
+    main()
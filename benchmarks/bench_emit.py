@@ -0,0 +1,46 @@
+"""
+Agent.emit throughput: one publish per emit, batched emits flushed every
+32 events in a single write, and the binary codec.
+"""
+from common import measure, report
+
+from uagent import BINARY, Agent
+
+N = 2000
+BATCH = 32
+
+
+def build_agent():
+    agent = Agent("bench", log_level="ERROR")
+    agent.connect()
+    return agent
+
+
+def main():
+    reading = {"agent": "esp32-kitchen", "temp": 21.5, "humidity": 48, "ok": True}
+
+    agent = build_agent()
+    direct = measure(lambda: agent.emit("sensor.kitchen.temp", **reading), N)
+    report("emit", mode="direct", us=direct, msg_per_s=int(1e6 / direct))
+
+    agent = build_agent()
+    agent.enable_batching(max_bytes=1 << 20)
+    state = [0]
+
+    def batched():
+        agent.emit("sensor.kitchen.temp", **reading)
+        state[0] += 1
+        if state[0] % BATCH == 0:
+            agent.flush()
+
+    us = measure(batched, N)
+    report("emit", mode="batched", us=us, msg_per_s=int(1e6 / us))
+
+    agent = build_agent()
+    agent.set_codec(BINARY)
+    us = measure(lambda: agent.emit("sensor.kitchen.temp", **reading), N)
+    report("emit", mode="binary", us=us, msg_per_s=int(1e6 / us))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Inbound message latency of Agent.run in "poll" and "select" loop modes.
+
+A background thread injects messages into the umqtt stand-in at random
+times; the handler records how long each message waited before being
+dispatched. Needs threads and socket.socketpair (CPython).
+"""
+import random
+import threading
+import time
+from socket import socketpair  # noqa: F401, the stand-in needs it to wake select
+
+from common import report
+
+from uagent import Agent
+
+MESSAGES = 50
+
+
+def run(mode):
+    agent = Agent("bench", log_level="ERROR", loop_mode=mode)
+    latencies = []
+
+    @agent.on_event("bench.ping")
+    def ping(sent):
+        latencies.append(time.perf_counter() - sent)
+        if len(latencies) >= MESSAGES:
+            agent.stop()
+
+    def inject():
+        while agent.client is None:
+            time.sleep(0.01)
+        for _ in range(MESSAGES):
+            time.sleep(random.uniform(0.005, 0.05))
+            msg = ('{"sent": %r}' % time.perf_counter()).encode()
+            agent.client.inject(b"bench/ping", msg)
+
+    thread = threading.Thread(target=inject)
+    thread.start()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    agent.run()
+    wall = time.perf_counter() - wall
+    cpu = time.process_time() - cpu
+    thread.join()
+
+    latencies.sort()
+    report(
+        "latency",
+        mode=mode,
+        mean_ms=sum(latencies) / len(latencies) * 1000,
+        p95_ms=latencies[int(len(latencies) * 0.95)] * 1000,
+        cpu_pct=cpu / wall * 100,
+    )
+
+
+def main():
+    run("poll")
+    run("select")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Cost of DEBUG calls that are present but disabled.
+
+"legacy" replays the old Logger, which entered _log() and compared the
+level on every call; "noop" is the current Logger at INFO; "buffer" runs
+at DEBUG into an in-memory LogBuffer sink, so nothing is formatted.
+"logging.debug" times a single log.debug() call, where the difference
+shows; "logging" times the whole _mqtt_callback dispatch path around it.
+"""
+
+from common import measure, report
+
+from uagent import Agent, LogBuffer, Logger
+
+N = 5000
+
+
+class LegacyLogger(Logger):
+    def set_level(self, level):
+        self.level = self.LEVELS.get(level.upper(), 20)
+
+    def debug(self, msg, *args):
+        self._log(10, msg, *args)
+
+    def info(self, msg, *args):
+        self._log(20, msg, *args)
+
+    def warning(self, msg, *args):
+        self._log(30, msg, *args)
+
+    def error(self, msg, *args):
+        self._log(40, msg, *args)
+
+    def critical(self, msg, *args):
+        self._log(50, msg, *args)
+
+
+def build_agent(log):
+    agent = Agent("bench")
+    agent.log = log
+
+    @agent.on_event("sensor.*.temp")
+    def handler(**kwargs):
+        pass
+
+    return agent
+
+
+def main():
+    topic = b"sensor/1/temp"
+    payload = b'{"value": 21.5, "unit": "C"}'
+    for name, log in (
+        ("legacy", LegacyLogger("bench", "INFO")),
+        ("noop", Logger("bench", "INFO")),
+        ("buffer", Logger("bench", "DEBUG", sink=LogBuffer(64))),
+    ):
+        us = measure(lambda: log.debug("a %s", 1), N * 20)
+        report("logging.debug", logger=name, us=us, calls_per_s=int(1e6 / us))
+        agent = build_agent(log)
+        us = measure(lambda: agent._mqtt_callback(topic, payload), N)
+        report("logging", logger=name, us=us, msg_per_s=int(1e6 / us))
+
+
+if __name__ == "__main__":
+    main()
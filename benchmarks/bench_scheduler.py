@@ -0,0 +1,37 @@
+"""
+Interval scheduler overhead: the cost of a loop pass when nothing is due,
+and the cost per firing when every task is due, for 10 to 1000 tasks.
+"""
+from common import measure, report
+
+from uagent import Agent
+
+N = 200
+
+
+def noop():
+    pass
+
+
+def main():
+    for count in (10, 100, 1000):
+        idle = Agent("bench", log_level="ERROR")
+        for _ in range(count):
+            idle.on_interval(3600)(noop)
+        idle._check_intervals()  # First run of each task is immediate
+
+        # A zero interval is due again on every pass
+        busy = Agent("bench", log_level="ERROR")
+        for _ in range(count):
+            busy.on_interval(0)(noop)
+
+        report(
+            "scheduler",
+            tasks=count,
+            idle_pass_us=measure(idle._check_intervals, N),
+            per_fire_us=measure(busy._check_intervals, 20) / count,
+        )
+
+
+if __name__ == "__main__":
+    main()
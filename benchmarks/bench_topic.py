@@ -0,0 +1,39 @@
+"""
+Cost of matching one topic against one pattern with Agent._topic_matches,
+and of an uncached TopicIndex lookup over the same patterns.
+"""
+from common import measure, report
+
+from uagent import Agent, TopicIndex
+
+N = 5000
+
+CASES = (
+    ("literal", "fleet.kitchen.sensor.temp"),
+    ("star", "fleet.*.sensor.temp"),
+    ("tail", "fleet.**"),
+    ("miss", "fleet.kitchen.sensor.humidity"),
+)
+
+
+def main():
+    agent = Agent("bench", log_level="ERROR")
+    topic = "fleet.kitchen.sensor.temp"
+    index = TopicIndex()
+    for name, pattern in CASES:
+        index.add(pattern)
+        report(
+            "topic_matches",
+            case=name,
+            us=measure(lambda: agent._topic_matches(pattern, topic), N),
+        )
+    report(
+        "topic_index",
+        patterns=len(CASES),
+        resolve_us=measure(lambda: index.resolve(topic), N),
+        cached_us=measure(lambda: index.match(topic), N),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Shared helpers for the benchmarks.
+
+Run benchmarks from this directory so that the in-memory umqtt stand-in
+shadows the real client, e.g. ``python bench_dispatch.py`` or
+``micropython bench_dispatch.py``. run.py runs them all and prints JSON.
+"""
+import sys
+import time
+
+sys.path.insert(0, "..")
+
+RESULTS = []  # Every report() as a dict, for run.py
+QUIET = False  # Skip the human readable lines
+
+try:
+    _ticks_us = time.ticks_us
+    _ticks_diff = time.ticks_diff
+
+    def now_us():
+        return _ticks_us()
+
+    def elapsed_us(start):
+        return _ticks_diff(_ticks_us(), start)
+
+except AttributeError:
+    _perf_counter = time.perf_counter
+
+    def now_us():
+        return _perf_counter() * 1e6
+
+    def elapsed_us(start):
+        return _perf_counter() * 1e6 - start
+
+
+def measure(func, n):
+    """Return mean microseconds per call of func() over n calls"""
+    start = now_us()
+    for _ in range(n):
+        func()
+    return elapsed_us(start) / n
+
+
+def report(name, **fields):
+    result = dict(fields)
+    result["bench"] = name
+    RESULTS.append(result)
+    if QUIET:
+        return
+    parts = []
+    for key in sorted(fields):
+        value = fields[key]
+        if isinstance(value, float):
+            value = "%.2f" % value
+        parts.append("%s=%s" % (key, value))
+    print("%-24s %s" % (name, " ".join(parts)))
@@ -0,0 +1,52 @@
+"""
+Run the benchmark suite and print the results as one JSON document.
+
+    cd benchmarks
+    python run.py > results.json
+    micropython run.py dispatch emit > results.json
+
+Benchmarks whose requirements are missing on this port (threads,
+socketpair, ...) are listed under "skipped".
+"""
+import json
+import sys
+
+import common
+
+BENCHMARKS = (
+    "dispatch",
+    "topic",
+    "emit",
+    "scheduler",
+    "logging",
+    "codec",
+    "alloc",
+    "latency",
+)
+
+
+def main(names):
+    common.QUIET = True
+    skipped = []
+    for name in names or BENCHMARKS:
+        try:
+            module = __import__("bench_" + name)
+        except ImportError as e:
+            skipped.append({"bench": name, "reason": str(e)})
+            continue
+        module.main()
+    print(
+        json.dumps(
+            {
+                "implementation": sys.implementation.name,
+                "version": ".".join(str(v) for v in sys.implementation.version[:3]),
+                "platform": sys.platform,
+                "results": common.RESULTS,
+                "skipped": skipped,
+            }
+        )
+    )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
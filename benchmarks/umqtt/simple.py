@@ -0,0 +1,95 @@
+"""
+In-memory stand-in for umqtt.simple used by the benchmarks.
+Nothing goes over the network; published messages are recorded and
+injected messages are delivered by check_msg(). Where socket.socketpair
+exists, sock becomes readable whenever a message is waiting, so the
+agent's select loop mode can be exercised as well.
+"""
+try:
+    import socket
+except ImportError:
+    import usocket as socket
+
+
+class MQTTException(Exception):
+    pass
+
+
+class FakeSocket:
+    """
+    One end of a socketpair: readable while messages are waiting, and
+    write() counts the bytes the agent sends instead of sending them.
+    """
+
+    def __init__(self, sock):
+        self._sock = sock
+        self.written = 0
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def recv(self, size):
+        return self._sock.recv(size)
+
+    def write(self, data):
+        self.written += len(data)
+        return len(data)
+
+    def close(self):
+        self._sock.close()
+
+
+class MQTTClient:
+    def __init__(self, client_id, server, port=0, **kwargs):
+        self.client_id = client_id
+        self.server = server
+        self.port = port
+        self.cb = None
+        self.sock = None
+        self.subscriptions = []
+        self.published = []
+        self._inbox = []
+
+    def set_callback(self, f):
+        self.cb = f
+
+    def connect(self, clean_session=True):
+        if hasattr(socket, "socketpair"):
+            sock, self._peer = socket.socketpair()
+            sock.setblocking(False)
+            self.sock = FakeSocket(sock)
+        return False
+
+    def disconnect(self):
+        if self.sock is not None:
+            self.sock.close()
+            self._peer.close()
+            self.sock = None
+
+    def subscribe(self, topic, qos=0):
+        self.subscriptions.append((topic, qos))
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        if len(self.published) >= 1000:
+            del self.published[:]  # Keep long benchmark runs bounded
+        self.published.append((topic, msg))
+
+    def inject(self, topic, msg):
+        """Queue an inbound message for the next check_msg()"""
+        self._inbox.append((topic, msg))
+        if self.sock is not None:
+            self._peer.send(b"\x00")
+
+    def wait_msg(self):
+        if self.sock is not None:
+            try:
+                if not self.sock.recv(1):
+                    return None
+            except OSError:
+                return None
+        if self._inbox:
+            topic, msg = self._inbox.pop(0)
+            self.cb(topic, msg)
+
+    def check_msg(self):
+        return self.wait_msg()
@@ -1,18 +1,111 @@
 from uagent import Agent
+import codecs
 import os
+import signal
+import subprocess
+import time
+
+
+class CommandRun:
+    """One command running as a subprocess, its output read without blocking"""
+
+    def __init__(self, run_id, cmd, reply_topic, timeout):
+        self.id = run_id
+        self.cmd = cmd
+        self.reply_topic = reply_topic
+        self.deadline = time.monotonic() + timeout
+        self.seq = 0  # Sequence number of the next reply message
+        self.killed = False
+        # New session so a timeout kills the whole pipeline, not just the shell
+        self.proc = subprocess.Popen(
+            cmd,
+            shell=True,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True,
+        )
+        self.streams = {}  # name -> (pipe, incremental utf-8 decoder)
+        decoder = codecs.getincrementaldecoder("utf-8")
+        for name in ("stdout", "stderr"):
+            pipe = getattr(self.proc, name)
+            os.set_blocking(pipe.fileno(), False)
+            self.streams[name] = (pipe, decoder("replace"))
+
+    def read(self, name, chunk_size):
+        """
+        Return the next chunk of 'name' output, "" if none is waiting. At
+        EOF the stream is removed and any undecoded tail returned.
+        """
+        pipe, decoder = self.streams[name]
+        try:
+            data = os.read(pipe.fileno(), chunk_size)
+        except BlockingIOError:
+            return ""
+        if not data:
+            pipe.close()
+            del self.streams[name]
+            return decoder.decode(b"", final=True)
+        return decoder.decode(data)
+
+    def kill(self):
+        self.killed = True
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass  # Exited meanwhile
 
 
 class CommandAgent(Agent):
-    def __init__(self, name="command", server="localhost", port=1883):
+    """
+    Runs registered shell commands as subprocesses, at most 'max_running'
+    at a time; further requests wait in a queue. Output streams to the
+    reply topic as it is produced, in messages of at most 'chunk_size'
+    bytes numbered by 'seq':
+
+        {"id": 3, "seq": 0, "command": "df -h", "stream": "stdout", "data": "..."}
+        {"id": 3, "seq": 1, "command": "df -h", "returncode": 0, "done": true}
+
+    Commands running longer than their timeout ('timeout' unless given
+    to register_command) are killed and their final message carries
+    error="timeout". Each pump pass reads at most 'max_chunks' chunks per
+    command, so a chatty command can't hold up the agent loop.
+    """
+
+    def __init__(
+        self,
+        name="command",
+        server="localhost",
+        port=1883,
+        max_running=4,
+        chunk_size=1024,
+        timeout=30,
+        pump_interval=0.05,
+        max_chunks=16,
+    ):
         super().__init__(name, server, port)
-        self.commands = {}  # event_topic -> (command_str, reply_topic)
+        self.commands = {}  # event_topic -> (command_str, reply_topic, timeout)
+        self.max_running = max_running
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks
+        self.timeout = timeout
+        self.running_commands = []  # [CommandRun, ...]
+        self.queued = []  # [(cmd, reply_topic, timeout), ...] waiting for a slot
+        self._next_id = 0
+        self.on_interval(pump_interval)(self.pump)
+        self.on_stop()(self.kill_all)
         self.log.info("CommandAgent initialized with name: %s", name)
 
-    def register_command(self, event_topic, command, reply_topic=None):
-        """Register a shell command to be executed when event_topic is received"""
+    def register_command(self, event_topic, command, reply_topic=None, timeout=None):
+        """
+        Register a shell command to be executed when event_topic is received,
+        killed after 'timeout' seconds (the agent's timeout if None)
+        """
         if reply_topic is None:
             reply_topic = f"{event_topic}.reply"
-        self.commands[event_topic] = (command, reply_topic)
+        if timeout is None:
+            timeout = self.timeout
+        self.commands[event_topic] = (command, reply_topic, timeout)
         self.log.info(
             "Registered command '%s' for event %s -> %s",
             command,
@@ -26,53 +119,66 @@ class CommandAgent(Agent):
             # Replace placeholders in command with event parameters
             for key, value in kwargs.items():
                 cmd = cmd.replace(f"{{{key}}}", str(value))
+            self.queued.append((cmd, reply_topic, timeout))
+            self.start_queued()
 
-            self.log.info("Executing command: %s", cmd)
+    def start_queued(self):
+        while self.queued and len(self.running_commands) < self.max_running:
+            cmd, reply_topic, timeout = self.queued.pop(0)
+            self._next_id += 1
+            self.log.info("Executing command %d: %s", self._next_id, cmd)
             try:
-                # Execute command using os.system
-                temp_out = "/tmp/cmd.out"
-                temp_err = "/tmp/cmd.err"
-                self.log.debug("Running: %s >%s 2>%s", cmd, temp_out, temp_err)
-                returncode = os.system(f"{cmd} >{temp_out} 2>{temp_err}")
-
-                # Read output from temporary files
-                stdout = stderr = ""
-                try:
-                    with open(temp_out, "r") as f:
-                        stdout = f.read()
-                except Exception as e:
-                    self.log.warning("Failed to read stdout: %s", str(e))
-
-                try:
-                    with open(temp_err, "r") as f:
-                        stderr = f.read()
-                except Exception as e:
-                    self.log.warning("Failed to read stderr: %s", str(e))
-
-                # Clean up temp files
-                try:
-                    os.unlink(temp_out)
-                    os.unlink(temp_err)
-                except Exception as e:
-                    self.log.warning("Failed to cleanup temp files: %s", str(e))
-
-                self.log.debug("Command completed with code %d", returncode)
-                if returncode != 0:
-                    self.log.warning("Command failed with code %d", returncode)
-                    if stderr:
-                        self.log.warning("stderr: %s", stderr)
-
-                # Emit reply with command output
+                run = CommandRun(self._next_id, cmd, reply_topic, timeout)
+            except Exception as e:
+                self.log.error("Command execution failed: %s", str(e))
                 self.emit(
                     reply_topic,
+                    id=self._next_id,
+                    seq=0,
                     command=cmd,
-                    stdout=stdout,
-                    stderr=stderr,
-                    returncode=returncode,
+                    error=str(e),
+                    returncode=-1,
+                    done=True,
                 )
-            except Exception as e:
-                self.log.error("Command execution failed: %s", str(e))
-                self.emit(reply_topic, command=cmd, error=str(e), returncode=-1)
+                continue
+            self.running_commands.append(run)
+
+    def pump(self):
+        """Stream new output, enforce time limits and reap finished commands"""
+        now = time.monotonic()
+        for run in list(self.running_commands):
+            if not run.killed and now > run.deadline:
+                self.log.warning("Command %d timed out, killing: %s", run.id, run.cmd)
+                run.kill()
+            for name in list(run.streams):
+                for _ in range(self.max_chunks):
+                    if name not in run.streams:
+                        break  # EOF
+                    data = run.read(name, self.chunk_size)
+                    if data:
+                        self.reply(run, stream=name, data=data)
+                    elif name in run.streams:
+                        break  # Nothing more waiting
+            if run.streams or run.proc.poll() is None:
+                continue
+            returncode = run.proc.returncode
+            self.running_commands.remove(run)
+            if run.killed:
+                self.reply(run, returncode=returncode, error="timeout", done=True)
+                continue
+            if returncode != 0:
+                self.log.warning("Command %d failed with code %d", run.id, returncode)
+            self.reply(run, returncode=returncode, done=True)
+        self.start_queued()
+
+    def reply(self, run, **kwargs):
+        self.emit(run.reply_topic, id=run.id, seq=run.seq, command=run.cmd, **kwargs)
+        run.seq += 1
+
+    def kill_all(self):
+        self.queued = []
+        for run in self.running_commands:
+            run.kill()
 
 
 def create_command_agent(commands, **kwargs):
@@ -21,18 +21,30 @@ def startup():
     print("-" * 50)
 
 
+# Command output arrives in chunks, collected per command run id
+output = {}  # run id -> [chunk, ...]
+
+
+def collect(name, kwargs):
+    """Gather stdout chunks, store the full text once the command is done"""
+    chunks = output.setdefault(kwargs.get("id"), [])
+    if kwargs.get("stream") == "stdout":
+        chunks.append(kwargs.get("data", ""))
+    if kwargs.get("done"):
+        del output[kwargs.get("id")]
+        if kwargs.get("returncode") == 0:
+            metrics[name] = "".join(chunks).strip()
+            display_metrics()
+
+
 @monitor.on_event("system.uptime.reply")
 def handle_uptime(**kwargs):
-    if kwargs.get("returncode") == 0:
-        metrics["uptime"] = kwargs.get("stdout", "").strip()
-        display_metrics()
+    collect("uptime", kwargs)
 
 
 @monitor.on_event("system.disk.status")
 def handle_disk(**kwargs):
-    if kwargs.get("returncode") == 0:
-        metrics["disk"] = kwargs.get("stdout", "").strip()
-        display_metrics()
+    collect("disk", kwargs)
 
 
 def display_metrics():
@@ -48,9 +60,8 @@ def display_metrics():
 
 @monitor.on_interval(CHECK_INTERVAL)
 def check_metrics():
-    # Request system metrics
-    monitor.emit("system.uptime")
-    monitor.emit("system.disk")
+    # Request system metrics in a single write
+    monitor.emit_many([("system.uptime", {}), ("system.disk", {})])
 
 
 if __name__ == "__main__":
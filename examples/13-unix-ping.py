@@ -12,6 +12,9 @@ LOG_LEVEL = "INFO"
 # Create ping monitoring agent
 agent = Agent(name=AGENT_NAME, server=MQTT_SERVER, port=MQTT_PORT, log_level=LOG_LEVEL)
 
+# Round-trip times are summarized locally, one ping.rtt summary per minute
+agent.aggregate("ping.rtt", window=60, stats=("min", "max", "mean", "count", "p95"))
+
 
 @agent.on_start()
 def startup():
@@ -32,6 +35,11 @@ def check_ping():
         with open("/tmp/ping.out", "r") as f:
             output = f.read()
 
+        # Sample each reply's "time=12.3 ms" into the aggregate
+        for line in output.splitlines():
+            if "time=" in line:
+                agent.sample("ping.rtt", float(line.split("time=")[1].split()[0]))
+
         # Emit results
         if returncode == 0:
             agent.emit(
@@ -53,16 +53,17 @@ def startup():
     dashboard.emit("ping.discover")  # Request current status from all agents
 
 
-@dashboard.on_event("ping.status")
-def handle_ping_status(agent, host, status, **kwargs):
-    """Handle incoming ping status updates"""
-    ping_status[agent] = {
-        "host": host,
-        "status": status,
-        "timestamp": time.time(),
-        "output": kwargs.get("output", ""),
-        "error": kwargs.get("error", ""),
-    }
+@dashboard.on_event("ping.status", coalesce=0.5, batch=True)
+def handle_ping_status(events):
+    """Apply every status update from the last half second, then redraw once"""
+    for topic, update in events:
+        ping_status[update["agent"]] = {
+            "host": update["host"],
+            "status": update["status"],
+            "timestamp": time.time(),
+            "output": update.get("output", ""),
+            "error": update.get("error", ""),
+        }
     display_dashboard()
 
 
@@ -0,0 +1,49 @@
+from uagent import Agent
+import machine
+import network
+import time
+
+AGENT_NAME = "sensor-1"
+WIFI_SSID = "WIFI-SSID"
+WIFI_PASSWORD = "WIFI-PASSWORD"
+SERVER_IP = "192.168.0.100"
+SERVER_PORT = 1883
+
+agent = Agent(name=AGENT_NAME, server=SERVER_IP, port=SERVER_PORT)
+adc = machine.ADC(machine.Pin(34))
+
+
+@agent.on_start(timeout=10)
+def connect_wifi():
+    wlan = network.WLAN(network.STA_IF)
+    wlan.active(True)
+    if not wlan.isconnected():
+        wlan.connect(WIFI_SSID, WIFI_PASSWORD)
+        for _ in range(50):
+            if wlan.isconnected():
+                break
+            time.sleep(0.1)
+
+
+@agent.on_interval(60)
+def read_sensor():
+    agent.emit("sensor.light", name=AGENT_NAME, value=adc.read())
+
+
+@agent.on_interval(3600)
+def report_battery():
+    agent.emit("sensor.battery", name=AGENT_NAME, volts=3.7)
+
+
+@agent.on_event("sensor.config")
+def configure(**kwargs):
+    print("New config:", kwargs)
+
+
+if __name__ == "__main__":
+    # Wake, do what's due, sleep until the next interval
+    sleep_ms = agent.run_once(drain=0.5)
+    if sleep_ms is None:
+        sleep_ms = 60000  # No intervals, check for config once a minute
+    # 0 means an interval is already due; deepsleep(0) would never wake
+    machine.deepsleep(max(sleep_ms, 1))
@@ -1,40 +1,1305 @@
-from umqtt.robust import MQTTClient
+from umqtt.simple import MQTTClient
 import time
 import json
+import random
+import struct
+
+try:
+    import os
+except ImportError:
+    import uos as os
+
+try:
+    import select
+except ImportError:
+    import uselect as select
+
+try:
+    import heapq
+except ImportError:
+    import uheapq as heapq
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ucollections import OrderedDict
+
+
+def _noop(*args):
+    pass
 
 
 class Logger:
     LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40, "CRITICAL": 50}
 
-    def __init__(self, name, level="INFO"):
+    def __init__(self, name, level="INFO", sink=None):
         self.name = name
-        level = level.upper()
-        self.level = self.LEVELS.get(level, 20)
+        self.sink = sink  # Called as sink(ts, level, fmt, args); print if None
+        self.set_level(level)
+
+    def set_level(self, level):
+        """
+        Rebind debug()/info()/... so that methods below the level are a
+        shared no-op and disabled calls never reach _log.
+        """
+        if isinstance(level, str):
+            level = self.LEVELS.get(level.upper(), 20)
+        self.level = level
+        for method, value in (
+            ("debug", 10),
+            ("info", 20),
+            ("warning", 30),
+            ("error", 40),
+            ("critical", 50),
+        ):
+            setattr(self, method, self._bind(value) if value >= level else _noop)
+
+    def _bind(self, level):
+        def log(msg, *args):
+            self._write(level, msg, args)
+
+        return log
 
     def _log(self, level, msg, *args):
         if level >= self.level:
-            if args:
-                msg = msg % args
-            print(f"{time.time():.3f} {self.name} [{level}] {msg}")
+            self._write(level, msg, args)
+
+    def _write(self, level, msg, args):
+        if self.sink is not None:
+            self.sink(time.time(), level, msg, args)
+            return
+        if args:
+            msg = msg % args
+        print(f"{time.time():.3f} {self.name} [{level}] {msg}")
+
+
+class RingBuffer:
+    """Fixed-size buffer keeping the most recent items"""
+
+    def __init__(self, size):
+        self.size = size
+        self._items = [None] * size
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        start = self._next - self._count
+        for i in range(start, self._next):
+            yield self._items[i % self.size]
+
+    def append(self, item):
+        self._items[self._next % self.size] = item
+        self._next = (self._next + 1) % self.size
+        if self._count < self.size:
+            self._count += 1
+
+    def clear(self):
+        self._items = [None] * self.size
+        self._next = 0
+        self._count = 0
+
+
+class LogBuffer(RingBuffer):
+    """
+    Logger sink keeping the last 'size' raw (ts, level, fmt, args) records.
+    Messages are only formatted when dumped, e.g.
+    agent.log.sink = LogBuffer(50) ... agent.emit("logs", lines=list(buf.lines()))
+    """
+
+    def __call__(self, ts, level, fmt, args):
+        self.append((ts, level, fmt, args))
+
+    def lines(self, name=""):
+        for ts, level, fmt, args in self:
+            msg = fmt % args if args else fmt
+            yield f"{ts:.3f} {name} [{level}] {msg}"
+
+    def dump(self, name="", write=print):
+        for line in self.lines(name):
+            write(line)
+
+
+def _wall_ms():
+    """Wall-clock milliseconds, for timings that span agents"""
+    if hasattr(time, "time_ns"):
+        return time.time_ns() // 1000000
+    return int(time.time() * 1000)
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _valid_trace(header):
+    """
+    True if 'header' carries a usable trace: "tr" as [id, origin ms] and,
+    when present, "rx" as [wall ms, monotonic, decode seconds]
+    """
+    tr = header.get("tr")
+    if not isinstance(tr, (list, tuple)) or len(tr) != 2:
+        return False
+    if not isinstance(tr[0], (str, int)) or not _is_number(tr[1]):
+        return False
+    rx = header.get("rx")
+    if rx is None:
+        return True
+    return isinstance(rx, (list, tuple)) and len(rx) == 3 and all(map(_is_number, rx))
+
+
+def _make_monotonic():
+    try:
+        ticks_ms, ticks_diff = time.ticks_ms, time.ticks_diff
+    except AttributeError:
+        return time.monotonic
+
+    # ticks_ms wraps around, so accumulate the differences instead
+    state = [ticks_ms(), 0]
+
+    def monotonic():
+        now = ticks_ms()
+        state[1] += ticks_diff(now, state[0])
+        state[0] = now
+        return state[1] / 1000
+
+    return monotonic
+
+
+# Seconds on a clock that never jumps, unlike time.time() under NTP
+monotonic = _make_monotonic()
+
+
+def _import_asyncio():
+    # Imported lazily so synchronous agents don't pay for the event loop
+    try:
+        import asyncio
+    except ImportError:
+        import uasyncio as asyncio
+    return asyncio
+
+
+class _TopicNode:
+    def __init__(self):
+        self.children = {}  # literal token -> _TopicNode
+        self.star = None  # "*" child
+        self.patterns = []  # patterns ending exactly at this node
+        self.tails = []  # patterns with "**" at this position
+
+
+class TopicIndex:
+    """
+    Token trie of NATS-style patterns supporting * and ** wildcards.
+    Resolved topics are kept in a bounded LRU cache.
+    """
+
+    def __init__(self, cache_size=128):
+        self._root = _TopicNode()
+        self._order = {}  # pattern -> registration sequence
+        self._cache = OrderedDict()  # topic -> [pattern, ...]
+        self.cache_size = cache_size
+
+    def __contains__(self, pattern):
+        return pattern in self._order
+
+    def __len__(self):
+        return len(self._order)
+
+    def add(self, pattern):
+        if pattern in self._order:
+            return
+        self._order[pattern] = len(self._order)
+        node = self._root
+        for token in pattern.split("."):
+            if token == "**":
+                # Anything after ** is ignored, as in Agent._topic_matches
+                node.tails.append(pattern)
+                break
+            if token == "*":
+                if node.star is None:
+                    node.star = _TopicNode()
+                node = node.star
+            else:
+                child = node.children.get(token)
+                if child is None:
+                    child = node.children[token] = _TopicNode()
+                node = child
+        else:
+            node.patterns.append(pattern)
+        self._cache.clear()
+
+    def resolve(self, topic):
+        """Return patterns matching topic, in registration order, uncached"""
+        patterns = []
+        self._collect(self._root, topic.split("."), 0, patterns)
+        if len(patterns) > 1:
+            patterns.sort(key=self._order.get)
+        return patterns
+
+    def match(self, topic):
+        """Return patterns matching topic, in registration order"""
+        cache = self._cache
+        patterns = cache.pop(topic, None)
+        if patterns is None:
+            patterns = self.resolve(topic)
+            if len(cache) >= self.cache_size:
+                del cache[next(iter(cache))]
+        cache[topic] = patterns
+        return patterns
+
+    def _collect(self, node, tokens, i, out):
+        if i == len(tokens):
+            out.extend(node.patterns)
+            return
+        if node.tails:
+            out.extend(node.tails)
+        child = node.children.get(tokens[i])
+        if child is not None:
+            self._collect(child, tokens, i + 1, out)
+        if node.star is not None:
+            self._collect(node.star, tokens, i + 1, out)
+
+
+class JSONCodec:
+    """Default payload codec, plain JSON objects"""
+
+    marker = None  # Payloads are recognised by the absence of a marker
+
+    def encode(self, obj):
+        return json.dumps(obj).encode()
+
+    def decode(self, data):
+        return json.loads(data)  # Parsed straight from bytes, no str copy
+
+
+class BinaryCodec:
+    """
+    Compact MessagePack subset: None, bool, int, float, str, bytes, lists
+    and dicts. Payloads start with a 0xC1 marker byte, which MessagePack
+    never uses, so receivers can tell them apart from JSON.
+    """
+
+    marker = 0xC1
+
+    def encode(self, obj):
+        buf = bytearray()
+        buf.append(self.marker)
+        self._pack(obj, buf)
+        return bytes(buf)
+
+    def decode(self, data):
+        if not data or data[0] != self.marker:
+            raise ValueError("Missing binary codec marker")
+        obj, end = self._unpack(data, 1)
+        if end != len(data):
+            raise ValueError("Trailing bytes after binary payload")
+        return obj
+
+    def _pack(self, obj, buf):
+        if obj is None:
+            buf.append(0xC0)
+        elif obj is True:
+            buf.append(0xC3)
+        elif obj is False:
+            buf.append(0xC2)
+        elif isinstance(obj, int):
+            if -32 <= obj < 128:
+                buf.append(obj & 0xFF)
+            elif 0 <= obj:
+                if obj < 0x100:
+                    buf += struct.pack(">BB", 0xCC, obj)
+                elif obj < 0x10000:
+                    buf += struct.pack(">BH", 0xCD, obj)
+                elif obj < 0x100000000:
+                    buf += struct.pack(">BI", 0xCE, obj)
+                else:
+                    buf += struct.pack(">BQ", 0xCF, obj)
+            elif -0x80 <= obj:
+                buf += struct.pack(">Bb", 0xD0, obj)
+            elif -0x8000 <= obj:
+                buf += struct.pack(">Bh", 0xD1, obj)
+            elif -0x80000000 <= obj:
+                buf += struct.pack(">Bi", 0xD2, obj)
+            else:
+                buf += struct.pack(">Bq", 0xD3, obj)
+        elif isinstance(obj, float):
+            try:
+                single = struct.pack(">f", obj)
+            except OverflowError:
+                single = None
+            if single is not None and struct.unpack(">f", single)[0] == obj:
+                buf.append(0xCA)
+                buf += single
+            else:
+                buf += struct.pack(">Bd", 0xCB, obj)
+        elif isinstance(obj, str):
+            data = obj.encode()
+            self._pack_header(buf, len(data), 0xA0, 32, 0xD9, 0xDA, 0xDB)
+            buf += data
+        elif isinstance(obj, (bytes, bytearray)):
+            self._pack_header(buf, len(obj), None, 0, 0xC4, 0xC5, 0xC6)
+            buf += obj
+        elif isinstance(obj, (list, tuple)):
+            self._pack_header(buf, len(obj), 0x90, 16, None, 0xDC, 0xDD)
+            for item in obj:
+                self._pack(item, buf)
+        elif isinstance(obj, dict):
+            self._pack_header(buf, len(obj), 0x80, 16, None, 0xDE, 0xDF)
+            for key, value in obj.items():
+                self._pack(key, buf)
+                self._pack(value, buf)
+        else:
+            raise TypeError("Cannot encode %s" % type(obj).__name__)
+
+    def _pack_header(self, buf, size, fix, fix_limit, op8, op16, op32):
+        if size < fix_limit:
+            buf.append(fix | size)
+        elif op8 is not None and size < 0x100:
+            buf += struct.pack(">BB", op8, size)
+        elif size < 0x10000:
+            buf += struct.pack(">BH", op16, size)
+        else:
+            buf += struct.pack(">BI", op32, size)
+
+    def _unpack(self, data, i):
+        op = data[i]
+        i += 1
+        if op < 0x80:
+            return op, i
+        if op >= 0xE0:
+            return op - 0x100, i
+        if op < 0x90:
+            return self._unpack_map(data, i, op & 0x0F)
+        if op < 0xA0:
+            return self._unpack_list(data, i, op & 0x0F)
+        if op < 0xC0:
+            size = op & 0x1F
+            return str(data[i : i + size], "utf-8"), i + size
+        if op == 0xC0:
+            return None, i
+        if op == 0xC2:
+            return False, i
+        if op == 0xC3:
+            return True, i
+        fmt = self._FORMATS.get(op)
+        if fmt is None:
+            raise ValueError("Unsupported binary type 0x%02x" % op)
+        value = struct.unpack_from(fmt, data, i)[0]
+        i += struct.calcsize(fmt)
+        if op in (0xC4, 0xC5, 0xC6):
+            return bytes(data[i : i + value]), i + value
+        if op in (0xD9, 0xDA, 0xDB):
+            return str(data[i : i + value], "utf-8"), i + value
+        if op in (0xDC, 0xDD):
+            return self._unpack_list(data, i, value)
+        if op in (0xDE, 0xDF):
+            return self._unpack_map(data, i, value)
+        return value, i
+
+    _FORMATS = {
+        0xC4: ">B",
+        0xC5: ">H",
+        0xC6: ">I",
+        0xCA: ">f",
+        0xCB: ">d",
+        0xCC: ">B",
+        0xCD: ">H",
+        0xCE: ">I",
+        0xCF: ">Q",
+        0xD0: ">b",
+        0xD1: ">h",
+        0xD2: ">i",
+        0xD3: ">q",
+        0xD9: ">B",
+        0xDA: ">H",
+        0xDB: ">I",
+        0xDC: ">H",
+        0xDD: ">I",
+        0xDE: ">H",
+        0xDF: ">I",
+    }
+
+    def _unpack_list(self, data, i, size):
+        items = []
+        for _ in range(size):
+            item, i = self._unpack(data, i)
+            items.append(item)
+        return items, i
+
+    def _unpack_map(self, data, i, size):
+        obj = {}
+        for _ in range(size):
+            key, i = self._unpack(data, i)
+            obj[key], i = self._unpack(data, i)
+        return obj, i
+
+
+JSON = JSONCodec()
+BINARY = BinaryCodec()
+
+
+def _encode_publish(topic, msg, qos=0, pid=0, dup=False):
+    """Encode an MQTT PUBLISH packet, QoS 1 ones carry packet id 'pid'"""
+    size = 2 + len(topic) + len(msg)
+    header = bytearray(1)
+    header[0] = 0x30 | qos << 1 | (0x08 if dup else 0)
+    if qos:
+        size += 2
+    while True:
+        byte = size & 0x7F
+        size >>= 7
+        header.append(byte | 0x80 if size else byte)
+        if not size:
+            break
+    header.append(len(topic) >> 8)
+    header.append(len(topic) & 0xFF)
+    if qos:
+        return header + topic + struct.pack(">H", pid) + msg
+    return header + topic + msg
+
+
+class Outbox:
+    """
+    Queue of encoded (mqtt_topic, payload) publishes waiting for a flush.
+    Coalesced topics keep a single slot whose payload is replaced by
+    each newer publish, so only the latest value goes out.
+    """
+
+    def __init__(self, max_bytes=1024):
+        self.max_bytes = max_bytes
+        self.size = 0  # Bytes of topics and payloads queued
+        self._items = []  # [[mqtt_topic, payload], ...]
+        self._slots = {}  # Coalesced mqtt_topic -> item
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, topic, payload, coalesce=False):
+        if coalesce:
+            item = self._slots.get(topic)
+            if item is not None:
+                self.size += len(payload) - len(item[1])
+                item[1] = payload
+                return
+        item = [topic, payload]
+        self._items.append(item)
+        if coalesce:
+            self._slots[topic] = item
+        self.size += len(topic) + len(payload)
+
+    def full(self):
+        return self.size >= self.max_bytes
+
+    def take(self):
+        items = self._items
+        self._items = []
+        self._slots = {}
+        self.size = 0
+        return items
+
+
+class OfflineBuffer:
+    """
+    Bounded FIFO of encoded (mqtt_topic, payload) publishes made while the
+    broker is unreachable. When full, "drop-oldest" discards the oldest
+    record, "drop-newest" refuses the new one and "sample" halves the
+    buffer, keeping every other record, then stores only every 2nd, 4th,
+    ... publish so the backlog still spans the whole outage.
+
+    RAM mode holds up to max_items records. With 'path' the records are
+    appended to a file instead, limited to max_bytes, which survives a
+    reboot and is read back one record at a time.
+    """
+
+    _HEADER = ">HI"  # topic length, payload length
+    _HEADER_SIZE = 6
+
+    def __init__(self, max_items=100, policy="drop-oldest", path=None, max_bytes=65536):
+        if policy not in ("drop-oldest", "drop-newest", "sample"):
+            raise ValueError("Unknown overflow policy: %s" % policy)
+        self.max_items = max_items
+        self.policy = policy
+        self.path = path
+        self.max_bytes = max_bytes
+        self.dropped = 0
+        self._stride = 1  # Sampling keeps every _stride-th publish
+        self._skipped = 0
+        self._items = []  # RAM mode records
+        self._head = 0  # File mode offset of the oldest record
+        self._end = 0  # File mode offset after the newest record
+        self._count = 0
+        if path is not None:
+            self._load()
+
+    def __len__(self):
+        return self._count if self.path is not None else len(self._items)
+
+    def add(self, topic, payload):
+        if self._stride > 1:
+            self._skipped += 1
+            if self._skipped < self._stride:
+                self.dropped += 1
+                return
+            self._skipped = 0
+        size = self._HEADER_SIZE + len(topic) + len(payload)
+        if self.path is not None and size > self.max_bytes:
+            self.dropped += 1
+            return
+        # Every pass frees a record or returns, so this always ends
+        while self._full(size):
+            if self.policy == "drop-newest" or not len(self):
+                self.dropped += 1
+                return
+            if self.policy == "drop-oldest" or len(self) == 1:
+                # Thinning a single record frees nothing, drop it instead
+                self.discard(1)
+                self.dropped += 1
+            else:
+                self._thin()
+                self._stride *= 2
+        if self.path is None:
+            self._items.append((topic, payload))
+            return
+        with open(self.path, "ab") as f:
+            f.write(struct.pack(self._HEADER, len(topic), len(payload)))
+            f.write(topic)
+            f.write(payload)
+        self._end += size
+        self._count += 1
+
+    def read(self, count):
+        """Return up to 'count' of the oldest records without removing them"""
+        if self.path is None:
+            return self._items[:count]
+        records = []
+        for offset, topic, payload in self._records():
+            records.append((topic, payload))
+            if len(records) >= count:
+                break
+        return records
+
+    def discard(self, count):
+        """Remove the 'count' oldest records"""
+        if self.path is None:
+            del self._items[:count]
+            if not self._items:
+                self._stride = 1
+            return
+        head = self._head
+        for head, topic, payload in self._records():
+            count -= 1
+            self._count -= 1
+            if not count:
+                break
+        if not self._count:
+            self._reset()
+            return
+        self._head = head
+        if self._head > self.max_bytes:
+            self._rewrite(lambda i: True)
+        else:
+            self._save_head()
+
+    def _full(self, size):
+        if self.path is None:
+            return len(self._items) >= self.max_items
+        return self._end - self._head + size > self.max_bytes
+
+    def _thin(self):
+        if self.path is None:
+            self.dropped += len(self._items) - len(self._items[::2])
+            self._items = self._items[::2]
+        else:
+            self._rewrite(lambda i: i % 2 == 0)
+
+    def _records(self):
+        """Yield (next_offset, topic, payload) from the oldest file record"""
+        with open(self.path, "rb") as f:
+            f.seek(self._head)
+            offset = self._head
+            while offset < self._end:
+                header = f.read(self._HEADER_SIZE)
+                if len(header) < self._HEADER_SIZE:
+                    return
+                topic_len, payload_len = struct.unpack(self._HEADER, header)
+                topic = f.read(topic_len)
+                payload = f.read(payload_len)
+                if len(payload) < payload_len:
+                    return
+                offset += self._HEADER_SIZE + topic_len + payload_len
+                yield offset, topic, payload
+
+    def _load(self):
+        try:
+            with open(self.path + ".head") as f:
+                self._head = int(f.read())
+        except (OSError, ValueError):
+            self._head = 0
+        try:
+            self._end = os.stat(self.path)[6]
+        except OSError:
+            self._head = self._end = 0
+            return
+        if self._head > self._end:
+            self._head = 0
+        size = self._end
+        offset = self._head
+        for offset, topic, payload in self._records():
+            self._count += 1
+        if offset != size:
+            # Torn write at the tail, keep only the complete records
+            self._end = offset
+            self._rewrite(lambda i: True)
+
+    def _rewrite(self, keep):
+        tmp = self.path + ".tmp"
+        count = end = 0
+        with open(tmp, "wb") as out:
+            for i, (offset, topic, payload) in enumerate(self._records()):
+                if not keep(i):
+                    self.dropped += 1
+                    continue
+                out.write(struct.pack(self._HEADER, len(topic), len(payload)))
+                out.write(topic)
+                out.write(payload)
+                count += 1
+                end += self._HEADER_SIZE + len(topic) + len(payload)
+        os.remove(self.path)
+        os.rename(tmp, self.path)
+        self._head = 0
+        self._end = end
+        self._count = count
+        self._save_head()
+
+    def _reset(self):
+        with open(self.path, "wb"):
+            pass
+        self._head = self._end = self._count = 0
+        self._stride = 1
+        self._save_head()
+
+    def _save_head(self):
+        with open(self.path + ".head", "w") as f:
+            f.write(str(self._head))
+
+
+class Inbox:
+    """
+    Bounded staging queue of decoded inbound messages. Lower priority
+    numbers are dispatched first, FIFO within a priority. When full,
+    "drop-oldest" drops the oldest message of the lowest priority and
+    "reject" drops the incoming one. "keep-latest" always replaces a
+    queued message on the same topic, otherwise it drops the oldest.
+    """
+
+    def __init__(self, max_depth=100, policy="drop-oldest"):
+        if policy not in ("drop-oldest", "keep-latest", "reject"):
+            raise ValueError("Unknown overflow policy: %s" % policy)
+        self.max_depth = max_depth
+        self.policy = policy
+        self.dropped = 0  # Queued messages discarded to make room
+        self.rejected = 0  # Incoming messages refused while full
+        self.replaced = 0  # Messages superseded by a newer one on the topic
+        self._queues = {}  # priority -> [[topic, payload, patterns], ...]
+        self._priorities = []  # Sorted priorities with a queue
+        self._latest = {}  # topic -> queued item, for keep-latest
+        self._depth = 0
+
+    def __len__(self):
+        return self._depth
+
+    def put(self, priority, topic, payload, patterns):
+        if self.policy == "keep-latest":
+            item = self._latest.get(topic)
+            if item is not None:
+                item[1] = payload
+                self.replaced += 1
+                return True
+        if self._depth >= self.max_depth:
+            if self.policy == "reject" or not self._drop_oldest(priority):
+                self.rejected += 1
+                return False
+        item = [topic, payload, patterns]
+        queue = self._queues.get(priority)
+        if queue is None:
+            queue = self._queues[priority] = []
+            self._priorities.append(priority)
+            self._priorities.sort()
+        queue.append(item)
+        if self.policy == "keep-latest":
+            self._latest[topic] = item
+        self._depth += 1
+        return True
+
+    def get(self):
+        """Remove and return (topic, payload, patterns), most urgent first"""
+        for priority in self._priorities:
+            queue = self._queues[priority]
+            if queue:
+                return self._remove(queue)
+        return None
 
-    def debug(self, msg, *args):
-        self._log(10, msg, *args)
+    def _drop_oldest(self, priority):
+        # Only make room at or below the incoming message's priority
+        for queued in reversed(self._priorities):
+            if queued < priority:
+                return False
+            queue = self._queues[queued]
+            if queue:
+                self._remove(queue)
+                self.dropped += 1
+                return True
+        return False
+
+    def _remove(self, queue):
+        item = queue.pop(0)
+        self._depth -= 1
+        if self.policy == "keep-latest" and self._latest.get(item[0]) is item:
+            del self._latest[item[0]]
+        return item
+
+
+class LastValueCache:
+    """
+    Latest payload per topic. Entries expire 'ttl' seconds after they were
+    stored (never with ttl=None), and the least recently stored or read
+    topics are evicted beyond 'max_entries' or 'max_bytes', counted as
+    topic plus encoded payload length.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=32768, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.evicted = 0
+        self._entries = OrderedDict()  # topic -> (payload, expires, size)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def put(self, topic, payload, size, now):
+        """Store payload, return True unless it equals the live cached value"""
+        entries = self._entries
+        changed = True
+        old = entries.pop(topic, None)
+        if old is not None:
+            self.bytes -= old[2]
+            changed = old[0] != payload or (old[1] is not None and old[1] <= now)
+        size += len(topic)
+        expires = None if self.ttl is None else now + self.ttl
+        entries[topic] = (payload, expires, size)
+        self.bytes += size
+        while len(entries) > 1 and (
+            len(entries) > self.max_entries or self.bytes > self.max_bytes
+        ):
+            oldest = next(iter(entries))
+            self.bytes -= entries.pop(oldest)[2]
+            self.evicted += 1
+        return changed
+
+    def get(self, topic, now):
+        entry = self._entries.pop(topic, None)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= now:
+            self.bytes -= entry[2]
+            return None
+        self._entries[topic] = entry  # Most recently used
+        return entry[0]
+
+    def match(self, pattern, matches, now):
+        """Return {topic: payload} for live entries where matches(pattern, topic)"""
+        found = {}
+        expired = []
+        for topic, (payload, expires, size) in self._entries.items():
+            if expires is not None and expires <= now:
+                expired.append(topic)
+            elif matches(pattern, topic):
+                found[topic] = payload
+        for topic in expired:
+            self.bytes -= self._entries.pop(topic)[2]
+        return found
+
+
+class _NoLock:
+    """Stand-in for threading.Lock while handlers run inline"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def _encode_subscribe(pid, filters):
+    """Encode one MQTT SUBSCRIBE packet for [(filter bytes, qos), ...]"""
+    body = bytearray(struct.pack(">H", pid))
+    for mqtt_filter, qos in filters:
+        body += struct.pack(">H", len(mqtt_filter))
+        body += mqtt_filter
+        body.append(qos)
+    return _encode_packet(0x82, body)
+
+
+def _encode_unsubscribe(pid, filters):
+    """Encode one MQTT UNSUBSCRIBE packet for [filter bytes, ...]"""
+    body = bytearray(struct.pack(">H", pid))
+    for mqtt_filter in filters:
+        body += struct.pack(">H", len(mqtt_filter))
+        body += mqtt_filter
+    return _encode_packet(0xA2, body)
+
+
+def _encode_packet(packet_type, body):
+    """Prefix 'body' with an MQTT fixed header"""
+    size = len(body)
+    header = bytearray(1)
+    header[0] = packet_type
+    while True:
+        byte = size & 0x7F
+        size >>= 7
+        header.append(byte | 0x80 if size else byte)
+        if not size:
+            break
+    return header + body
+
+
+def _filter_covers(general, specific):
+    """True if every topic matching MQTT filter 'specific' matches 'general'"""
+    g_parts = general.split("/")
+    s_parts = specific.split("/")
+    for i, token in enumerate(g_parts):
+        if token == "#":
+            return True
+        if i >= len(s_parts) or s_parts[i] == "#":
+            return False
+        if token != "+" and (s_parts[i] == "+" or token != s_parts[i]):
+            return False
+    return len(g_parts) == len(s_parts)
+
+
+def _minimal_filters(filters):
+    """Drop MQTT filters already covered by another filter in the list"""
+    kept = []
+    for mqtt_filter in filters:
+        if any(_filter_covers(k, mqtt_filter) for k in kept):
+            continue
+        kept = [k for k in kept if not _filter_covers(mqtt_filter, k)]
+        kept.append(mqtt_filter)
+    return kept
+
+
+class Histogram:
+    """
+    Latency histogram over fixed millisecond bounds. The integer buckets
+    are allocated once, recording a value only increments one of them.
+    """
+
+    BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self, bounds=BOUNDS_MS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)  # Last bucket is overflow
+        self.count = 0
+        self.total_ms = 0
+
+    def add(self, seconds):
+        ms = int(seconds * 1000)
+        i = 0
+        for bound in self.bounds:
+            if ms <= bound:
+                break
+            i += 1
+        self.buckets[i] += 1
+        self.count += 1
+        self.total_ms += ms
+
+    def snapshot(self):
+        return {"n": self.count, "sum": self.total_ms, "buckets": list(self.buckets)}
+
+
+class Metrics:
+    """
+    Runtime counters and latency histograms of an agent: messages and
+    bytes in and out, decode failures, unmatched topics, per-handler
+    calls, errors and durations, and interval lag (actual minus
+    scheduled fire time).
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.messages_in = 0
+        self.messages_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.decode_errors = 0
+        self.unmatched = 0
+        self.reconnects = 0
+        self.handlers = {}  # handler name -> [calls, errors, Histogram]
+        self.interval_lag = Histogram()
+
+    def record_handler(self, name, seconds, failed):
+        stats = self.handlers.get(name)
+        if stats is None:
+            stats = self.handlers[name] = [0, 0, Histogram()]
+        stats[0] += 1
+        if failed:
+            stats[1] += 1
+        stats[2].add(seconds)
+
+    def snapshot(self):
+        return {
+            "uptime": int(time.time() - self.started),
+            "messages_in": self.messages_in,
+            "messages_out": self.messages_out,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "decode_errors": self.decode_errors,
+            "unmatched": self.unmatched,
+            "reconnects": self.reconnects,
+            "handlers": {
+                name: {"calls": calls, "errors": errors, "ms": hist.snapshot()}
+                for name, (calls, errors, hist) in self.handlers.items()
+            },
+            "interval_lag_ms": self.interval_lag.snapshot(),
+            "bounds_ms": list(Histogram.BOUNDS_MS),
+        }
+
+
+class P2Quantile:
+    """
+    Streaming estimate of quantile 'q' (0..1) in constant memory, using
+    the P-square algorithm's five markers.
+    """
+
+    def __init__(self, q):
+        self.q = q
+        self.heights = []  # Marker heights, the first five samples sorted
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * q, 1 + 4 * q, 3 + 2 * q, 5]
+        self.increments = (0, q / 2, q, (1 + q) / 2, 1)
+
+    def add(self, x):
+        h = self.heights
+        if len(h) < 5:
+            h.append(x)
+            h.sort()
+            return
+        n = self.positions
+        if x < h[0]:
+            h[0] = x
+            k = 0
+        elif x >= h[4]:
+            h[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= h[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                # Parabolic prediction, linear if it leaves the neighbours
+                height = h[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (h[i + 1] - h[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - d) * (h[i] - h[i - 1]) / (n[i] - n[i - 1])
+                )
+                if not h[i - 1] < height < h[i + 1]:
+                    height = h[i] + d * (h[i + d] - h[i]) / (n[i + d] - n[i])
+                h[i] = height
+                n[i] += d
+
+    def value(self):
+        h = self.heights
+        if not h:
+            return None
+        if len(h) < 5:
+            return h[int(round(self.q * (len(h) - 1)))]
+        return h[2]
+
+
+def _quantile(stat):
+    """Quantile of percentile 'stat' ("p95" -> 0.95), None if not one"""
+    digits = stat[1:]
+    if stat[:1] != "p" or not digits.replace(".", "", 1).isdigit():
+        return None
+    percent = float(digits)
+    return percent / 100 if 0 < percent < 100 else None
+
+
+class Aggregate:
+    """
+    Constant-memory summary of the samples of one window: any of "min",
+    "max", "mean", "sum", "count" and percentiles such as "p95" or "p99.9".
+    """
+
+    STATS = ("min", "max", "mean", "sum", "count")
+
+    def __init__(self, stats=("min", "max", "mean", "count", "p95")):
+        for stat in stats:
+            if stat not in self.STATS and _quantile(stat) is None:
+                raise ValueError("Unknown statistic: %s" % stat)
+        self.stats = stats
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.quantiles = {}  # stat -> P2Quantile
+        for stat in self.stats:
+            if stat not in self.STATS:
+                self.quantiles[stat] = P2Quantile(_quantile(stat))
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        for sketch in self.quantiles.values():
+            sketch.add(value)
+
+    def summary(self):
+        values = {
+            "min": self.min,
+            "max": self.max,
+            "sum": self.total,
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+        }
+        out = {}
+        for stat in self.stats:
+            sketch = self.quantiles.get(stat)
+            out[stat] = values[stat] if sketch is None else sketch.value()
+        return out
+
+
+class Coalescer:
+    """
+    Holds back messages for one handler and releases them together.
+    With debounce=False the handler runs 'window' seconds after the first
+    held message, so at most once per window; with debounce=True it runs
+    once no message arrived for 'window' seconds. Keeps the latest payload
+    per topic, or every (topic, payload) in order when 'batch' is set.
+    """
+
+    def __init__(self, handler, timeout, pattern, window, debounce=False, batch=False):
+        self.handler = handler
+        self.timeout = timeout
+        self.pattern = pattern
+        self.window = window
+        self.debounce = debounce
+        self.batch = batch
+        self.fire_at = None  # Release time while messages are held
+        self.pending = [] if batch else OrderedDict()
+
+    def add(self, topic, payload, now):
+        if self.batch:
+            self.pending.append((topic, payload))
+        else:
+            self.pending[topic] = payload
+        if self.debounce or self.fire_at is None:
+            self.fire_at = now + self.window
 
-    def info(self, msg, *args):
-        self._log(20, msg, *args)
+    def take(self):
+        pending = self.pending
+        self.pending = [] if self.batch else OrderedDict()
+        self.fire_at = None
+        return pending
 
-    def warning(self, msg, *args):
-        self._log(30, msg, *args)
 
-    def error(self, msg, *args):
-        self._log(40, msg, *args)
+class IntervalTask:
+    def __init__(self, func, interval, timeout, mode="rate", jitter=0):
+        if mode not in ("rate", "delay"):
+            raise ValueError("Unknown interval mode: %s" % mode)
+        self.func = func
+        self.interval = interval
+        self.timeout = timeout
+        self.mode = mode
+        self.jitter = jitter
+        self.due = 0  # Scheduled run time before jitter
+        self.fire_at = 0  # Scheduled run time including jitter
 
-    def critical(self, msg, *args):
-        self._log(50, msg, *args)
+
+class Scheduler:
+    """
+    Min-heap of IntervalTask deadlines on the monotonic clock.
+    "rate" tasks run on a fixed grid (due + interval), skipping runs that
+    were missed entirely; "delay" tasks run interval seconds after the
+    previous run finished. Jitter adds a random 0..jitter second offset
+    to each run without shifting the grid.
+    """
+
+    def __init__(self):
+        self.tasks = []  # In the order they were added
+        self._heap = []  # [(fire_at, seq, task), ...]
+        self._seq = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def add(self, task, now=None):
+        task.due = monotonic() if now is None else now
+        self.tasks.append(task)
+        self._push(task)
+
+    def restore(self, dues):
+        """Set each task's next run from monotonic times in add() order"""
+        self._heap = []
+        for task, due in zip(self.tasks, dues):
+            task.due = due
+            self._push(task)
+
+    def _push(self, task):
+        fire_at = task.due
+        if task.jitter:
+            fire_at += random.random() * task.jitter
+        task.fire_at = fire_at
+        self._seq += 1
+        heapq.heappush(self._heap, (fire_at, self._seq, task))
+
+    def next_deadline(self):
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        """Remove and return the earliest task due at now, or None"""
+        if self._heap and self._heap[0][0] <= now:
+            return heapq.heappop(self._heap)[2]
+        return None
+
+    def reschedule(self, task, now):
+        if task.mode == "delay" or task.interval <= 0:
+            task.due = now + task.interval
+        else:
+            task.due += task.interval
+            if task.due < now:
+                skipped = int((now - task.due) / task.interval) + 1
+                task.due += skipped * task.interval
+        self._push(task)
+
+
+class RequestError(Exception):
+    """The responding agent's handler raised while answering a request"""
+
+
+class RequestTimeout(RequestError):
+    """No reply arrived before the request deadline"""
+
+
+class Reply:
+    """
+    Pending result of Agent.request(), completed once by the reply or by
+    the request deadline. Callbacks run on the agent loop with the Reply.
+    """
+
+    def __init__(self, agent, cid):
+        self.cid = cid
+        self.value = None  # Reply kwargs
+        self.error = None
+        self._agent = agent
+        self._done = False
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def add_done_callback(self, callback):
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def result(self, timeout=None):
+        """
+        Return the reply kwargs or raise its error. On a sync agent this
+        runs the agent loop until the reply arrives; from inside handlers
+        prefer a callback. AsyncAgent callers use 'await reply.wait()'.
+        """
+        agent = self._agent
+        deadline = None if timeout is None else monotonic() + timeout
+        while not self._done:
+            if deadline is not None and monotonic() >= deadline:
+                raise RequestTimeout("No reply to request %s yet" % self.cid)
+            agent._tick()
+            if not self._done:
+                agent._wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    async def wait(self):
+        """Wait for the reply without blocking an AsyncAgent's loop"""
+        if not self._done:
+            event = _import_asyncio().Event()
+            self.add_done_callback(lambda reply: event.set())
+            await event.wait()
+        return self.result()
+
+    def _set(self, value, error):
+        self.value = value
+        self.error = error
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                self._agent.log.error("Reply callback failed: %s", str(e))
+                self._agent._handle_error(e)
+
+
+class SleepState:
+    """
+    A small JSON document kept across deep sleep, in RTC memory where the
+    port has it (machine.RTC().memory()), otherwise in file 'path'.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._rtc = None
+        if path is None:
+            try:
+                import machine
+
+                self._rtc = machine.RTC()
+                self._rtc.memory  # AttributeError where the port lacks it
+            except (ImportError, AttributeError):
+                raise ValueError("No RTC memory here, pass a state file path")
+
+    def load(self):
+        try:
+            if self._rtc is not None:
+                data = self._rtc.memory()
+            else:
+                with open(self.path, "rb") as f:
+                    data = f.read()
+            return json.loads(data) if data else {}
+        except (OSError, ValueError):
+            return {}  # Cold boot or torn write, start fresh
+
+    def save(self, state):
+        data = json.dumps(state).encode()
+        if self._rtc is not None:
+            self._rtc.memory(data)
+        else:
+            with open(self.path, "wb") as f:
+                f.write(data)
 
 
 class Agent:
-    def __init__(self, name, server="localhost", port=1883, log_level="INFO"):
+    def __init__(
+        self, name, server="localhost", port=1883, log_level="INFO", loop_mode="poll"
+    ):
         self.name = name
         self.server = server
         self.port = port
@@ -42,6 +1307,16 @@ class Agent:
         self.running = False
         self.log = Logger(name, level=log_level)
 
+        # Main loop: "poll" sleeps poll_interval between passes, "select" blocks
+        # on the MQTT socket until a message arrives or an interval is due.
+        if loop_mode not in ("poll", "select"):
+            raise ValueError("Unknown loop mode: %s" % loop_mode)
+        self.loop_mode = loop_mode
+        self.poll_interval = 0.1
+        self.max_wait = 1.0  # Longest select wait, so stop() is noticed
+        self._poller = None
+        self._poller_sock = None
+
         # Handler storage
         self._start_handlers = []
         self._stop_handlers = []
@@ -49,8 +1324,82 @@ class Agent:
         self._disconnect_handlers = []
         self._error_handlers = []
         self._event_handlers = {}  # topic -> [(handler, timeout), ...]
-        self._interval_handlers = []  # [(func, interval, timeout, last_run), ...]
+        self._topic_index = TopicIndex()
+        self._routes = OrderedDict()  # raw mqtt topic -> (topic, patterns)
+        self._scheduler = Scheduler()  # Interval handlers
+        self._outbox = None  # Outbox when batching is enabled
+        self._offline = None  # OfflineBuffer for emits while disconnected
+        self._replay_batch = 32
+        self._executor = None  # HandlerExecutor when handlers run on a pool
+        self._concurrency = {}  # handler -> max_concurrency
+        self._send_lock = _NoLock()  # Guards the client and outbound queues
+        self._inbox = None  # Inbox staging inbound messages when enabled
+        self._priorities = {}  # pattern -> inbox priority
+        self._priority_index = TopicIndex()
+        self._default_priority = 10
+        self._read_budget = 32  # Messages read per loop pass into the inbox
+        self._dispatch_budget = 8  # Messages dispatched per loop pass
+        self._received = 0
+        self.metrics = None  # Metrics when enabled
+        self.client_factory = MQTTClient  # Transport, anything MQTTClient-like
+        self._hub = None  # LoopbackHub this agent is attached to
+        self._local = []  # [(topic, payload), ...] delivered through the hub
+        self._coalesce = TopicIndex()  # Topics where the latest emit wins
+        self.codec = JSON  # Outbound codec unless a topic pattern overrides it
+        self._codecs = {}  # pattern -> codec
+        self._codec_index = TopicIndex()
+        self._decoders = {BINARY.marker: BINARY}  # marker byte -> codec
         self._translate_topics = True  # Enable topic translation by default
+        self._subscriptions = []  # MQTT filters subscribed on the broker
+        self._reply_topic = None  # Private topic for replies, set on first request
+        self._pending = {}  # correlation id -> Reply
+        self._deadlines = []  # [(deadline, correlation id), ...] min-heap
+        self._next_cid = 0
+        self._envelope_handlers = set()  # Handlers that get the "$" header
+        self._coalescers = {}  # handler -> Coalescer
+        self._aggregates = {}  # topic -> Aggregate
+        self._traces = None  # RingBuffer of trace records when tracing
+        self._trace_sample = 0  # Fraction of emits carrying a trace header
+        self._trace_seq = 0
+        self.qos = 0  # Publish QoS unless a topic pattern overrides it
+        self._qos = {}  # pattern -> publish QoS
+        self._qos_index = TopicIndex()
+        self._sub_qos = {}  # pattern -> subscription QoS
+        # QoS 1 publishes go out without waiting for their PUBACK; at most
+        # max_inflight stay unacknowledged, later ones wait in a queue of
+        # up to max_queued, and unacknowledged ones are resent after
+        # qos_retry seconds.
+        self.max_inflight = 16
+        self.max_queued = 100
+        self.qos_retry = 5.0
+        self._inflight = OrderedDict()  # packet id -> (mqtt topic, payload, sent)
+        self._qos_queue = []  # [(mqtt topic, payload), ...]
+        self._next_pid = 0
+        self.qos_retries = 0
+        self.qos_dropped = 0
+        self._subacks = {}  # packet id -> [mqtt filter, ...] awaiting SUBACK
+
+        # Reconnects are driven by the loop: after a failed connect or a
+        # dropped connection the next attempt waits reconnect_min seconds,
+        # doubling up to reconnect_max, with jitter so a fleet spreads out.
+        # Persistent sessions let the broker keep our subscriptions. A new
+        # process can't tell what a previous run left in its session, so
+        # its first connect starts a clean one.
+        self.clean_session = False
+        self._session_known = False
+        self.reconnect_min = 1.0
+        self.reconnect_max = 60.0
+        self._reconnect_at = None  # Monotonic time of the next attempt
+        self._reconnect_attempts = 0
+        self._share_group = None  # Shared subscription group in an AgentGroup
+        self._worker = None  # (index, count) in an AgentGroup
+        self._affinity = {}  # pattern -> key function, or None for the topic
+        self._affinity_index = TopicIndex()
+        self._affine_filters = ()  # MQTT filters partitioned by key
+        self._last_values = None  # LastValueCache when enabled
+        self._last_value_index = TopicIndex()  # Patterns kept in the cache
+        self._change_handlers = {}  # pattern -> [(handler, timeout), ...]
+        self._change_index = TopicIndex()
 
     def _to_mqtt_topic(self, topic):
         """Convert NATS-style topic to MQTT-style"""
@@ -60,6 +1409,158 @@ class Agent:
         """Convert MQTT-style topic to NATS-style"""
         return topic.replace("/", ".") if self._translate_topics else topic
 
+    def _to_mqtt_filter(self, pattern):
+        """Convert NATS-style pattern to an MQTT filter, * -> + and ** -> #"""
+        if not self._translate_topics:
+            return pattern
+        tokens = []
+        for token in pattern.split("."):
+            if token == "**":
+                tokens.append("#")
+                break
+            tokens.append("+" if token == "*" else token)
+        return "/".join(tokens)
+
+    def _subscribe(self, patterns):
+        """
+        Subscribe to the smallest set of MQTT filters covering 'patterns',
+        skipping any filter the broker already delivers to us, all in one
+        SUBSCRIBE packet whose SUBACK is read by the loop. Filters made
+        redundant by a broader one are then unsubscribed, as brokers may
+        deliver a message once per matching subscription.
+        """
+        filters = {}  # mqtt filter -> subscription QoS
+        for pattern in patterns:
+            mqtt_filter = self._to_mqtt_filter(pattern)
+            qos = self._sub_qos.get(pattern, 0)
+            filters[mqtt_filter] = max(filters.get(mqtt_filter, 0), qos)
+        wanted = []
+        for mqtt_filter in _minimal_filters(list(filters)):
+            if any(_filter_covers(s, mqtt_filter) for s in self._subscriptions):
+                continue
+            # Also at the QoS of subscribed patterns it replaces
+            qos = max(
+                [q for f, q in filters.items() if _filter_covers(mqtt_filter, f)]
+                + [
+                    q
+                    for p, q in self._sub_qos.items()
+                    if _filter_covers(mqtt_filter, self._to_mqtt_filter(p))
+                ]
+            )
+            wanted.append((mqtt_filter, qos))
+        if not wanted:
+            return
+        covered = [
+            s
+            for s in self._subscriptions
+            if any(_filter_covers(f, s) for f, q in wanted)
+        ]
+        write = getattr(getattr(self.client, "sock", None), "write", None)
+        if write is None:
+            for mqtt_filter, qos in wanted:
+                self._subscribe_one(mqtt_filter, qos)
+        else:
+            self._subscribe_many(write, wanted)
+        covered = [s for s in covered if s not in self._subscriptions]
+        if covered:
+            self._unsubscribe(covered)
+
+    def _subscribe_many(self, write, wanted):
+        self.log.debug("Subscribing to: %s", ", ".join(f for f, q in wanted))
+        filters = [(self._shared(f).encode(), q) for f, q in wanted]
+        with self._send_lock:
+            pid = self._alloc_pid()
+            try:
+                write(_encode_subscribe(pid, filters))
+            except Exception as e:
+                self.log.error("Failed to subscribe: %s", str(e))
+                return
+            self._subacks[pid] = [f for f, q in wanted]
+            self._subscriptions = _minimal_filters(
+                self._subscriptions + self._subacks[pid]
+            )
+
+    def _unsubscribe(self, filters):
+        self.log.debug("Unsubscribing from: %s", ", ".join(filters))
+        filters = [self._shared(f).encode() for f in filters]
+        write = getattr(getattr(self.client, "sock", None), "write", None)
+        try:
+            if write is not None:
+                with self._send_lock:
+                    write(_encode_unsubscribe(self._alloc_pid(), filters))
+            elif hasattr(self.client, "unsubscribe"):
+                for mqtt_filter in filters:
+                    self.client.unsubscribe(mqtt_filter)
+        except Exception as e:
+            self.log.error("Failed to unsubscribe: %s", str(e))
+
+    def _subscribe_one(self, mqtt_filter, qos):
+        self.log.debug("Subscribing to: %s", mqtt_filter)
+        try:
+            self.client.subscribe(self._shared(mqtt_filter).encode(), qos)
+            self.log.info("Subscribed to: %s", mqtt_filter)
+        except Exception as e:
+            self.log.error("Failed to subscribe to %s: %s", mqtt_filter, str(e))
+            return
+        self._subscriptions = _minimal_filters(self._subscriptions + [mqtt_filter])
+
+    def _shared(self, mqtt_filter):
+        """Filter as subscribed, through the AgentGroup's shared subscription"""
+        if self._share_group is None or mqtt_filter in self._affine_filters:
+            return mqtt_filter
+        if mqtt_filter.startswith("_inbox/"):
+            return mqtt_filter  # Request replies belong to this worker
+        return "$share/%s/%s" % (self._share_group, mqtt_filter)
+
+    def _join_group(self, group, index, count, affinity):
+        """Configure this copy of the agent as worker 'index' of an AgentGroup"""
+        self.name = self.log.name = "%s-%d" % (self.name, index)
+        self._share_group = group
+        self._worker = (index, count)
+        for pattern, key in affinity.items():
+            self._affinity[pattern] = key
+            self._affinity_index.add(pattern)
+        self._affine_filters = [self._to_mqtt_filter(p) for p in affinity]
+
+    def _owns(self, topic):
+        """True unless 'topic' is partitioned by key and belongs to another worker"""
+        patterns = self._affinity_index.match(topic)
+        if not patterns:
+            return True
+        import zlib
+
+        key = self._affinity[patterns[0]]
+        key = topic if key is None else key(topic)
+        index, count = self._worker
+        return zlib.crc32(key.encode()) % count == index
+
+    def _handle_suback(self):
+        # check_msg() returns the SUBACK type byte, the rest is ours
+        sock = self.client.sock
+        size = shift = 0
+        while True:
+            byte = sock.read(1)[0]
+            size |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        data = sock.read(size)
+        filters = self._subacks.pop(data[0] << 8 | data[1], ())
+        for mqtt_filter, code in zip(filters, data[2:]):
+            if code == 0x80:
+                self.log.error("Broker refused subscription to %s", mqtt_filter)
+                if mqtt_filter in self._subscriptions:
+                    self._subscriptions.remove(mqtt_filter)
+                    # Narrower filters it replaced were unsubscribed, restore them
+                    self._subscribe(
+                        p
+                        for p in self._event_handlers
+                        if self._to_mqtt_filter(p) != mqtt_filter
+                        and _filter_covers(mqtt_filter, self._to_mqtt_filter(p))
+                    )
+            else:
+                self.log.info("Subscribed to: %s", mqtt_filter)
+
     def on_start(self, timeout=10):
         def decorator(func):
             self._start_handlers.append((func, timeout))
@@ -95,89 +1596,835 @@ class Agent:
 
         return decorator
 
-    def on_event(self, topic, timeout=10):
+    def on_event(
+        self,
+        topic,
+        timeout=10,
+        max_concurrency=None,
+        coalesce=None,
+        debounce=None,
+        batch=False,
+        qos=0,
+    ):
+        """
+        Execute handler for events matching 'topic', subscribed at 'qos'.
+        With an executor enabled, 'max_concurrency' limits how many
+        messages this handler processes at once.
+        'coalesce=seconds' runs the handler at most once per window and
+        'debounce=seconds' once messages pause that long, each time with
+        the latest payload per topic, or with batch=True as
+        handler(events=[(topic, payload), ...]).
+        """
+        if coalesce is not None and debounce is not None:
+            raise ValueError("Use either coalesce or debounce, not both")
+
         def decorator(func):
-            if topic not in self._event_handlers:
-                self._event_handlers[topic] = []
+            if qos:
+                self._sub_qos[topic] = max(self._sub_qos.get(topic, 0), qos)
+            self._add_pattern(topic)
             self._event_handlers[topic].append((func, timeout))
-            if self.client:
-                # Subscribe using MQTT style topic
-                mqtt_topic = self._to_mqtt_topic(topic)
-                self.log.debug("Subscribing to topic: %s (mqtt: %s)", topic, mqtt_topic)
-                self.client.subscribe(mqtt_topic.encode())
+            if max_concurrency is not None:
+                self._concurrency[func] = max_concurrency
+            if coalesce is not None or debounce is not None:
+                window = debounce if coalesce is None else coalesce
+                self._coalescers[func] = Coalescer(
+                    func, timeout, topic, window, debounce is not None, batch
+                )
             return func
 
         return decorator
 
-    def on_interval(self, interval, timeout=None):
+    def on_request(self, topic, timeout=10):
+        """
+        Answer request() calls on 'topic'. A dict returned by the handler
+        becomes the reply kwargs, any other value is sent as {"result":
+        value}. If the handler raises, the requester gets a RequestError.
+        """
+
+        def decorator(func):
+            def request_handler(**kwargs):
+                header = kwargs.pop("$", None)
+                if header is None or "reply" not in header:
+                    return func(**kwargs)  # Plain emit, nobody to answer
+                try:
+                    result = func(**kwargs)
+                except Exception as e:
+                    self._send_reply(header, None, e)
+                    raise
+                if hasattr(result, "send"):  # Coroutine handler on AsyncAgent
+                    return self._reply_when_done(header, result)
+                self._send_reply(header, result, None)
+
+            try:
+                request_handler.__name__ = func.__name__
+            except AttributeError:
+                pass  # MicroPython functions have no writable attributes
+            self._envelope_handlers.add(request_handler)
+            self.on_event(topic, timeout)(request_handler)
+            return func
+
+        return decorator
+
+    def on_change(self, topic, timeout=10):
+        """
+        Execute handler for events matching 'topic' only when the payload
+        differs from the last one cached for that topic, or it expired.
+        Enables the last-value cache with defaults if needed.
+        """
+
+        def decorator(func):
+            if self._last_values is None:
+                self.enable_last_values(patterns=())
+            if topic not in self._change_handlers:
+                self._change_handlers[topic] = []
+                self._change_index.add(topic)
+                self._last_value_index.add(topic)
+            self._change_handlers[topic].append((func, timeout))
+            self._add_pattern(topic)
+            return func
+
+        return decorator
+
+    def _add_pattern(self, topic):
+        if topic not in self._event_handlers:
+            self._event_handlers[topic] = []
+            self._topic_index.add(topic)
+            self._routes.clear()
+            if self.client:
+                self._subscribe([topic])
+
+    def on_interval(self, interval, timeout=None, mode="rate", jitter=0):
         """
         Execute handler every 'interval' seconds.
         If timeout is None, uses interval as timeout.
+        mode="rate" keeps a fixed schedule, mode="delay" waits 'interval'
+        seconds after each run. 'jitter' spreads runs by up to that many
+        seconds so a fleet of agents doesn't fire in lockstep.
         """
         if timeout is None:
             timeout = interval
 
         def decorator(func):
-            self._interval_handlers.append((func, interval, timeout, 0))
+            self._scheduler.add(IntervalTask(func, interval, timeout, mode, jitter))
             return func
 
         return decorator
 
+    def aggregate(
+        self, topic, window=60, stats=("min", "max", "mean", "count", "p95")
+    ):
+        """
+        Summarize values passed to agent.sample(topic, value), or to the
+        returned Aggregate's add(), and emit one summary per 'window'
+        seconds to 'topic', e.g. {"min": 1, "max": 9, "p95": 8.5, ...}.
+        Windows without samples emit nothing.
+        """
+        aggregate = Aggregate(stats)
+        self._aggregates[topic] = aggregate
+
+        def emit_summary():
+            if aggregate.count:
+                summary = aggregate.summary()
+                aggregate.reset()
+                self.emit(topic, window=window, **summary)
+
+        task = IntervalTask(emit_summary, window, window)
+        self._scheduler.add(task, monotonic() + window)  # First one after a window
+        return aggregate
+
+    def sample(self, topic, value):
+        """Add value to the aggregate of 'topic'"""
+        self._aggregates[topic].add(value)
+
+    def enable_batching(self, max_bytes=1024, coalesce=()):
+        """
+        Queue emits and publish them together once per loop pass, or as
+        soon as 'max_bytes' are queued. For topics matching a 'coalesce'
+        pattern only the latest emit since the last flush is sent.
+        """
+        self._outbox = Outbox(max_bytes)
+        for pattern in coalesce:
+            self._coalesce.add(pattern)
+
+    def enable_executor(self, max_workers=4, kind="thread"):
+        """
+        Run event handlers on a thread (or process) pool instead of inline,
+        so a slow handler doesn't hold up the message loop. CPython only,
+        with uagent_host.py installed alongside.
+        """
+        import threading
+        from uagent_host import HandlerExecutor
+
+        self._executor = HandlerExecutor(self, max_workers, kind)
+        self._send_lock = threading.RLock()
+
+    def enable_inbox(
+        self,
+        max_depth=100,
+        policy="drop-oldest",
+        priorities=None,
+        default_priority=10,
+        read_budget=32,
+        dispatch_budget=8,
+    ):
+        """
+        Stage inbound messages in a bounded Inbox instead of handling each
+        one inside check_msg(). Each loop pass reads up to 'read_budget'
+        messages and dispatches up to 'dispatch_budget', most urgent first,
+        so a flood on one topic can't starve interval handlers.
+        'priorities' maps topic patterns to priorities, lower runs first,
+        e.g. {"control.**": 0}. Overflow counters are on agent.inbox.
+        """
+        self._inbox = Inbox(max_depth, policy)
+        for pattern, priority in (priorities or {}).items():
+            self._priorities[pattern] = priority
+            self._priority_index.add(pattern)
+        self._default_priority = default_priority
+        self._read_budget = read_budget
+        self._dispatch_budget = dispatch_budget
+
+    @property
+    def inbox(self):
+        return self._inbox
+
+    def enable_metrics(self, publish_interval=None, topic=None):
+        """
+        Collect runtime Metrics, read them with agent.metrics.snapshot().
+        With 'publish_interval' seconds the snapshot is also emitted in a
+        single message to 'topic', by default $agent.<name>.metrics.
+        """
+        self.metrics = Metrics()
+        if publish_interval:
+            self._metrics_topic = topic or "$agent.%s.metrics" % self.name
+            self._scheduler.add(
+                IntervalTask(self._publish_metrics, publish_interval, publish_interval)
+            )
+
+    def metrics_snapshot(self):
+        """Metrics snapshot plus the inbox, offline and executor counters"""
+        snapshot = self.metrics.snapshot()
+        if self._inbox is not None:
+            snapshot["inbox"] = {
+                "depth": len(self._inbox),
+                "dropped": self._inbox.dropped,
+                "rejected": self._inbox.rejected,
+                "replaced": self._inbox.replaced,
+            }
+        if self._offline is not None:
+            snapshot["offline"] = {
+                "depth": len(self._offline),
+                "dropped": self._offline.dropped,
+            }
+        if self._executor is not None:
+            snapshot["overruns"] = dict(self._executor.overruns)
+        if self.qos or self._qos:
+            snapshot["qos"] = {
+                "inflight": len(self._inflight),
+                "queued": len(self._qos_queue),
+                "retries": self.qos_retries,
+                "dropped": self.qos_dropped,
+            }
+        if self._last_values is not None:
+            snapshot["last_values"] = {
+                "entries": len(self._last_values),
+                "bytes": self._last_values.bytes,
+                "evicted": self._last_values.evicted,
+            }
+        return snapshot
+
+    def _publish_metrics(self):
+        self.emit(self._metrics_topic, **self.metrics_snapshot())
+
+    def enable_last_values(
+        self, patterns=(), ttl=None, max_entries=256, max_bytes=32768
+    ):
+        """
+        Cache the latest payload of every received topic matching one of
+        'patterns', or an on_change pattern, in a LastValueCache, read with
+        agent.latest(pattern). The patterns are subscribed even without
+        handlers, so keep them as narrow as the node needs.
+        """
+        self._last_values = LastValueCache(max_entries, max_bytes, ttl)
+        for pattern in patterns:
+            self._last_value_index.add(pattern)
+            self._add_pattern(pattern)
+
+    @property
+    def last_values(self):
+        return self._last_values
+
+    def latest(self, pattern):
+        """Return {topic: payload} of cached topics matching 'pattern'"""
+        if self._last_values is None:
+            raise RuntimeError("Last-value cache not enabled")
+        now = monotonic()
+        if "*" not in pattern:
+            payload = self._last_values.get(pattern, now)
+            return {} if payload is None else {pattern: payload}
+        return self._last_values.match(pattern, self._topic_matches, now)
+
+    def _cache_last_value(self, topic, payload, size):
+        if isinstance(payload, dict) and "$" in payload:
+            if topic == self._reply_topic:
+                return
+            payload = {k: v for k, v in payload.items() if k != "$"}
+        if size is None:  # Hub delivery, kwargs never encoded
+            try:
+                size = len(JSON.encode(payload))
+            except (TypeError, ValueError):
+                size = len(repr(payload))  # Not JSON-serializable, estimate
+        changed = self._last_values.put(topic, payload, size, monotonic())
+        if changed and self._change_handlers:
+            for pattern in self._change_index.match(topic):
+                for handler, timeout in self._change_handlers[pattern]:
+                    self._call_handler(handler, timeout, topic, payload)
+
+    def enable_tracing(self, sample=0.01, size=256, publish_interval=None, topic=None):
+        """
+        Trace a 'sample' fraction of emits end to end. Traced emits carry
+        a trace id and origin time in the "$" header, which handlers never
+        see. Receiving agents with tracing enabled record, per handler:
+        transit_ms from origin to receipt (wall clocks, so only as good as
+        their sync), decode_ms, queue_ms from receipt to dispatch, and
+        handler_ms (inline handlers; with an executor or AsyncAgent, the
+        hand-off). The emitting agent records encode_ms. The last 'size'
+        records are kept for agent.traces(); with 'publish_interval'
+        seconds they are also emitted to 'topic', by default
+        $agent.<name>.traces, and cleared.
+        """
+        self._traces = RingBuffer(size)
+        self._trace_sample = sample
+        if publish_interval:
+            self._traces_topic = topic or "$agent.%s.traces" % self.name
+            self._scheduler.add(
+                IntervalTask(self._publish_traces, publish_interval, publish_interval)
+            )
+
+    def traces(self):
+        """Recorded trace records, oldest first"""
+        return list(self._traces) if self._traces is not None else []
+
+    def _publish_traces(self):
+        if len(self._traces):
+            records = list(self._traces)
+            self._traces.clear()
+            self.emit(self._traces_topic, traces=records)
+
+    def _start_trace(self, kwargs):
+        """Return kwargs with a trace header added to its "$" envelope"""
+        self._trace_seq += 1
+        header = dict(kwargs.get("$") or {})
+        header["tr"] = ["%s.%d" % (self.name, self._trace_seq), _wall_ms()]
+        kwargs = dict(kwargs)
+        kwargs["$"] = header
+        return kwargs
+
+    def _record_trace(self, topic, header, handler, dispatched, finished):
+        trace_id, origin = header["tr"]
+        received = header.get("rx")  # [wall ms, monotonic, decode seconds]
+        if received is None:  # Delivered through the hub, nothing decoded
+            received = [_wall_ms(), dispatched, 0]
+        self._traces.append(
+            {
+                "id": trace_id,
+                "topic": topic,
+                "agent": self.name,
+                "handler": handler.__name__,
+                "transit_ms": received[0] - origin,
+                "decode_ms": int(received[2] * 1000000) / 1000,
+                "queue_ms": int((dispatched - received[1]) * 1000000) / 1000,
+                "handler_ms": int((finished - dispatched) * 1000000) / 1000,
+            }
+        )
+
+    def enable_offline_buffer(
+        self,
+        max_items=100,
+        policy="drop-oldest",
+        path=None,
+        max_bytes=65536,
+        replay_batch=32,
+    ):
+        """
+        Keep emits made while disconnected in an OfflineBuffer instead of
+        dropping them, and replay them 'replay_batch' at a time, in a single
+        write, once per loop pass after reconnecting.
+        """
+        self._offline = OfflineBuffer(max_items, policy, path, max_bytes)
+        self._replay_batch = replay_batch
+
+    def set_codec(self, codec, pattern=None):
+        """
+        Encode emits with 'codec', for all topics or those matching
+        'pattern'. Inbound payloads are decoded by marker byte whatever
+        codec is configured here.
+        """
+        if codec.marker is not None:
+            self._decoders[codec.marker] = codec
+        if pattern is None:
+            self.codec = codec
+            return
+        self._codecs[pattern] = codec
+        self._codec_index.add(pattern)
+
+    def set_qos(self, qos, pattern=None):
+        """
+        Publish emits at 'qos' (0 or 1), for all topics or those matching
+        'pattern'. QoS 1 publishes are pipelined, see max_inflight.
+        """
+        if qos not in (0, 1):
+            raise ValueError("Unsupported QoS: %s" % qos)
+        if pattern is None:
+            self.qos = qos
+            return
+        self._qos[pattern] = qos
+        self._qos_index.add(pattern)
+
+    def _qos_for(self, mqtt_topic):
+        if self._qos:
+            topic = self._from_mqtt_topic(mqtt_topic.decode())
+            patterns = self._qos_index.match(topic)
+            if patterns:
+                return self._qos[patterns[0]]
+        return self.qos
+
+    def _codec_for(self, topic):
+        if self._codecs:
+            patterns = self._codec_index.match(topic)
+            if patterns:
+                return self._codecs[patterns[0]]
+        return self.codec
+
+    def _decode(self, msg):
+        codec = self._decoders.get(msg[0], JSON) if msg else JSON
+        return codec.decode(msg)
+
     def emit(self, topic, **kwargs):
-        if not self.client:
+        self.emit_many(((topic, kwargs),))
+
+    def emit_many(self, events):
+        """Emit (topic, kwargs) pairs, sent in a single socket write"""
+        with self._send_lock:
+            self._emit_many(events)
+
+    def _emit_many(self, events):
+        hub = self._hub
+        if not self.client and self._offline is None and hub is None:
             err = RuntimeError("Not connected to MQTT broker")
             self.log.error(str(err))
             self._handle_error(err)
             return
         try:
-            mqtt_topic = self._to_mqtt_topic(topic)
-            payload = json.dumps(kwargs).encode()
-            self.log.debug("Emitting to %s (mqtt: %s): %s", topic, mqtt_topic, kwargs)
-            self.client.publish(mqtt_topic.encode(), payload)
+            items = []
+            for topic, kwargs in events:
+                self.log.debug("Emitting to %s: %s", topic, kwargs)
+                traced = (
+                    self._trace_sample
+                    and not topic.startswith("$")  # Not our metrics and traces
+                    and random.random() < self._trace_sample
+                )
+                if traced:
+                    kwargs = self._start_trace(kwargs)
+                recipients = None
+                if hub is not None:
+                    local_only, recipients = hub.deliver(topic, kwargs)
+                    if local_only or self.server is None:
+                        continue
+                    if not self.client and self._offline is None:
+                        self.log.debug("Not connected, %s only sent locally", topic)
+                        continue
+                mqtt_topic = self._to_mqtt_topic(topic).encode()
+                if traced:
+                    start = monotonic()
+                payload = self._codec_for(topic).encode(kwargs)
+                if traced:
+                    self._traces.append(
+                        {
+                            "id": kwargs["$"]["tr"][0],
+                            "topic": topic,
+                            "agent": self.name,
+                            "encode_ms": int((monotonic() - start) * 1000000) / 1000,
+                        }
+                    )
+                if recipients:
+                    hub.expect_echo(recipients, mqtt_topic, payload)
+                if self._outbox is None:
+                    items.append((mqtt_topic, payload))
+                else:
+                    coalesce = bool(self._coalesce.match(topic))
+                    self._outbox.add(mqtt_topic, payload, coalesce)
+        except Exception as e:
+            self.log.error("Failed to emit event: %s", str(e))
+            self._handle_error(e)
+            return
+        if items:
+            self._publish_many(items)
+        elif self._outbox is not None and self._outbox.full():
+            self.flush()
+
+    def flush(self):
+        """Publish everything queued by batching emits"""
+        if self._outbox is not None and len(self._outbox):
+            if self.client or self._offline is not None:
+                with self._send_lock:
+                    self._publish_many(self._outbox.take())
+
+    def _publish_many(self, items):
+        offline = self._offline
+        if offline is not None and (not self.client or len(offline)):
+            # Queue behind the backlog so events go out in order
+            for mqtt_topic, payload in items:
+                offline.add(mqtt_topic, payload)
+            return
+        try:
+            self._write(items)
         except Exception as e:
             self.log.error("Failed to emit event: %s", str(e))
+            if offline is not None:
+                for mqtt_topic, payload in items:
+                    offline.add(mqtt_topic, payload)
+            if isinstance(e, OSError):
+                self._connection_lost(e)
             self._handle_error(e)
 
+    def _write(self, items):
+        if self.metrics is not None:
+            self.metrics.messages_out += len(items)
+            for mqtt_topic, payload in items:
+                self.metrics.bytes_out += len(payload)
+        sock = getattr(self.client, "sock", None)
+        write = getattr(sock, "write", None)
+        qos_for = self._qos_for if self.qos or self._qos else None
+        if write is None or (len(items) == 1 and qos_for is None):
+            for mqtt_topic, payload in items:
+                qos = qos_for(mqtt_topic) if qos_for else 0
+                if qos:
+                    self.client.publish(mqtt_topic, payload, False, qos)  # Blocks
+                else:
+                    self.client.publish(mqtt_topic, payload)
+            return
+        packets = bytearray()
+        for mqtt_topic, payload in items:
+            if qos_for is not None and qos_for(mqtt_topic):
+                packets += self._track_qos1(mqtt_topic, payload)
+            else:
+                packets += _encode_publish(mqtt_topic, payload)
+        if packets:
+            write(packets)
+
+    def _track_qos1(self, mqtt_topic, payload):
+        """Return the QoS 1 packet to send, or b"" if the window is full"""
+        if self._qos_queue or len(self._inflight) >= self.max_inflight:
+            if len(self._qos_queue) >= self.max_queued:
+                self._qos_queue.pop(0)
+                self.qos_dropped += 1
+                self.log.warning("QoS 1 queue full, dropped oldest publish")
+            self._qos_queue.append((mqtt_topic, payload))
+            return b""
+        return self._send_qos1(mqtt_topic, payload)
+
+    def _send_qos1(self, mqtt_topic, payload):
+        pid = self._alloc_pid()
+        self._inflight[pid] = (mqtt_topic, payload, monotonic())
+        return _encode_publish(mqtt_topic, payload, 1, pid)
+
+    def _alloc_pid(self):
+        pid = self._next_pid
+        while True:
+            pid = pid % 0xFFFF + 1  # Packet ids run 1..65535
+            if pid not in self._inflight and pid not in self._subacks:
+                break
+        self._next_pid = pid
+        return pid
+
+    def _handle_puback(self):
+        # umqtt's check_msg() returns the PUBACK type byte, the rest is ours
+        data = self.client.sock.read(3)
+        pid = data[1] << 8 | data[2]
+        with self._send_lock:
+            if self._inflight.pop(pid, None) is None:
+                self.log.debug("PUBACK for unknown packet id %d", pid)
+            queue = self._qos_queue
+            room = self.max_inflight - len(self._inflight)
+            if queue and room > 0:
+                batch, self._qos_queue = queue[:room], queue[room:]
+                packets = bytearray()
+                for mqtt_topic, payload in batch:
+                    packets += self._send_qos1(mqtt_topic, payload)
+                self.client.sock.write(packets)
+
+    def _retry_inflight(self, resend_all=False):
+        """Resend unacknowledged QoS 1 publishes with the DUP flag set"""
+        write = getattr(getattr(self.client, "sock", None), "write", None)
+        if write is None:
+            return
+        inflight = self._inflight
+        now = monotonic()
+        packets = bytearray()
+        resent = 0
+        with self._send_lock:
+            for pid in list(inflight):
+                mqtt_topic, payload, sent = inflight[pid]
+                if not resend_all and now - sent < self.qos_retry:
+                    break  # Sent in order, the rest are newer
+                del inflight[pid]
+                inflight[pid] = (mqtt_topic, payload, now)
+                packets += _encode_publish(mqtt_topic, payload, 1, pid, True)
+                resent += 1
+            if resent:
+                self.qos_retries += resent
+                self.log.debug("Resending %d unacknowledged publishes", resent)
+                write(packets)
+
+    def _replay_offline(self):
+        offline = self._offline
+        if offline is None or not self.client or not len(offline):
+            return
+        with self._send_lock:
+            count = self._replay_batch
+            if self.qos or self._qos:
+                # Records leave the buffer only once the QoS 1 window can send
+                # them, queued ones could be evicted before they go out
+                if self._qos_queue:
+                    return
+                count = min(count, self.max_inflight - len(self._inflight))
+                if count <= 0:
+                    return
+            batch = offline.read(count)
+            try:
+                self._write(batch)
+            except Exception as e:
+                self.log.error("Failed to replay buffered events: %s", str(e))
+                if isinstance(e, OSError):
+                    self._connection_lost(e)
+                self._handle_error(e)
+                return
+            offline.discard(len(batch))
+        self.log.debug("Replayed %d buffered events", len(batch))
+
+    def request(self, topic, timeout=5, callback=None, **kwargs):
+        """
+        Send kwargs to the on_request handler for 'topic' and return a
+        Reply. Replies come back on this agent's private reply topic and
+        are matched by correlation id, so any number of requests can be in
+        flight at once. 'callback' runs with the Reply when it completes,
+        or with a RequestTimeout error after 'timeout' seconds.
+        """
+        with self._send_lock:
+            if self._reply_topic is None:
+                self._reply_topic = "_inbox.%s.%08x" % (
+                    self.name,
+                    random.getrandbits(32),
+                )
+                self._add_pattern(self._reply_topic)
+            self._next_cid += 1
+            cid = self._next_cid
+            reply = Reply(self, cid)
+            if callback is not None:
+                reply.add_done_callback(callback)
+            self._pending[cid] = reply
+            heapq.heappush(self._deadlines, (monotonic() + timeout, cid))
+            kwargs["$"] = {"cid": cid, "reply": self._reply_topic}
+            self._emit_many(((topic, kwargs),))
+        return reply
+
+    def _send_reply(self, header, result, error):
+        if result is None:
+            kwargs = {}
+        elif isinstance(result, dict):
+            kwargs = dict(result)
+        else:
+            kwargs = {"result": result}
+        reply_header = {"cid": header.get("cid")}
+        if error is not None:
+            reply_header["error"] = "%s: %s" % (type(error).__name__, error)
+        kwargs["$"] = reply_header
+        self.emit_many(((header["reply"], kwargs),))
+
+    async def _reply_when_done(self, header, coro):
+        try:
+            result = await coro
+        except Exception as e:
+            self._send_reply(header, None, e)
+            raise
+        self._send_reply(header, result, None)
+
+    def _complete_request(self, header, payload):
+        cid = header.get("cid")
+        if not isinstance(cid, int):
+            self.log.debug("Dropped malformed reply: %s", header)
+            return
+        with self._send_lock:
+            reply = self._pending.pop(cid, None)
+        if reply is None:
+            self.log.debug("Dropped late or unknown reply: %s", header)
+            return
+        error = header.get("error")
+        reply._set(payload, RequestError(error) if error else None)
+
+    def _expire_requests(self):
+        deadlines = self._deadlines
+        now = monotonic()
+        while deadlines and deadlines[0][0] <= now:
+            with self._send_lock:
+                cid = heapq.heappop(deadlines)[1]
+                reply = self._pending.pop(cid, None)
+            if reply is not None:
+                self.log.warning("Request %s timed out", cid)
+                reply._set(None, RequestTimeout("No reply to request %s" % cid))
+
+    def _route(self, mqtt_topic):
+        """Resolve raw topic bytes to (topic, patterns), cached on the bytes"""
+        routes = self._routes
+        route = routes.pop(mqtt_topic, None)
+        if route is None:
+            topic = self._from_mqtt_topic(mqtt_topic.decode())
+            route = (topic, self._topic_index.resolve(topic))
+            if len(routes) >= self._topic_index.cache_size:
+                del routes[next(iter(routes))]
+        routes[mqtt_topic] = route
+        return route
+
     def _mqtt_callback(self, topic, msg):
-        mqtt_topic = topic.decode()
-        nats_topic = self._from_mqtt_topic(mqtt_topic)
-        self.log.debug(
-            "Received message on topic: %s (nats: %s)", mqtt_topic, nats_topic
-        )
+        self._received += 1  # Even if skipped below, it came off the socket
+        if self._hub is not None and self._hub.is_echo(self, topic, msg):
+            return  # Already delivered through the hub
+        topic, patterns = self._route(topic)
+        if self._affinity and not self._owns(topic):
+            return  # Another worker's key
+        self.log.debug("Received message on topic: %s", topic)
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.messages_in += 1
+            metrics.bytes_in += len(msg)
+        start = monotonic()
         try:
-            payload = json.loads(msg.decode())
+            payload = self._decode(msg)
             self.log.debug("Decoded payload: %s", payload)
+            # Handlers take the payload as keyword arguments
+            if not isinstance(payload, dict) or not all(
+                isinstance(key, str) for key in payload
+            ):
+                raise ValueError("Payload is not an object with string keys")
         except Exception as e:
             self.log.warning("Failed to decode payload: %s", str(e))
             payload = {}
+            if metrics is not None:
+                metrics.decode_errors += 1
+
+        if self._traces is not None and isinstance(payload, dict):
+            header = payload.get("$")
+            if isinstance(header, dict) and "tr" in header:
+                header["rx"] = [_wall_ms(), start, monotonic() - start]
+        self._receive(topic, payload, patterns, len(msg))
+
+    def _receive(self, topic, payload, patterns, size=None):
+        if self._last_values is not None and self._last_value_index.match(topic):
+            self._cache_last_value(topic, payload, size)
+        if self._inbox is None or not patterns:
+            self._dispatch(topic, payload, patterns)
+            return
+        priority = self._default_priority
+        if self._priorities:
+            matched = self._priority_index.match(topic)
+            if matched:
+                priority = self._priorities[matched[0]]
+        if not self._inbox.put(priority, topic, payload, patterns):
+            self.log.debug("Inbox full, rejected message on %s", topic)
+
+    def _check_msg(self):
+        # Acks are read until the socket is empty, only messages use the budget
+        budget = 1 if self._inbox is None else self._read_budget
+        while budget:
+            received = self._received
+            op = self.client.check_msg()
+            if op == 0x40:
+                self._handle_puback()
+            elif op == 0x90:
+                self._handle_suback()
+            elif op == 0xB0:
+                self.client.sock.read(3)  # UNSUBACK, nothing to track
+            elif self._received == received:
+                break  # Nothing more waiting on the socket
+            else:
+                budget -= 1
+
+    def _drain_local(self):
+        local = self._local
+        while local:
+            topic, payload = local.pop(0)
+            if self.metrics is not None:
+                self.metrics.messages_in += 1
+            self._receive(topic, payload, self._topic_index.match(topic))
+
+    def _drain_inbox(self):
+        if self._inbox is None:
+            return
+        for _ in range(self._dispatch_budget):
+            item = self._inbox.get()
+            if item is None:
+                break
+            self._dispatch(*item)
+
+    def _dispatch(self, topic, payload, patterns=None):
+        header = None
+        if isinstance(payload, dict) and isinstance(payload.get("$"), dict):
+            # Envelope header, only on_request handlers see it
+            header = payload["$"]
+            payload = {k: v for k, v in payload.items() if k != "$"}
+            if topic == self._reply_topic:
+                self._complete_request(header, payload)
+                return
 
         # Find matching topic handlers
-        matched = False
-        for pattern, handlers in self._event_handlers.items():
-            self.log.debug("Checking pattern: %s", pattern)
-            if self._topic_matches(pattern, nats_topic):
-                matched = True
-                self.log.debug("Pattern matched: %s", pattern)
-                for handler, timeout in handlers:
-                    try:
-                        start_time = time.time()
-                        self.log.debug("Calling handler: %s", handler.__name__)
-                        handler(**payload)
-                        if time.time() - start_time > timeout:
-                            self.log.warning(
-                                "Handler %s exceeded timeout", handler.__name__
-                            )
-                    except Exception as e:
-                        self.log.error(
-                            "Handler %s failed: %s", handler.__name__, str(e)
-                        )
-                        self._handle_error(e)
-
-        if not matched:
-            self.log.warning("No handlers matched topic: %s", nats_topic)
+        if patterns is None:
+            patterns = self._topic_index.match(topic)
+        # Malformed trace headers from other agents are ignored, not recorded
+        traced = (
+            self._traces is not None and header is not None and _valid_trace(header)
+        )
+        coalescers = self._coalescers
+        for pattern in patterns:
+            for handler, timeout in self._event_handlers[pattern]:
+                kwargs = payload
+                if header is not None and handler in self._envelope_handlers:
+                    kwargs = dict(payload)
+                    kwargs["$"] = header
+                if coalescers and handler in coalescers:
+                    coalescers[handler].add(topic, kwargs, monotonic())
+                elif traced:
+                    dispatched = monotonic()
+                    self._call_handler(handler, timeout, topic, kwargs)
+                    self._record_trace(topic, header, handler, dispatched, monotonic())
+                else:
+                    self._call_handler(handler, timeout, topic, kwargs)
+
+        if not patterns:
+            self.log.warning("No handlers matched topic: %s", topic)
+            if self.metrics is not None:
+                self.metrics.unmatched += 1
+
+    def _call_handler(self, handler, timeout, topic, kwargs):
+        if self._executor is None:
+            self._run_handler(handler, timeout, **kwargs)
+        else:
+            self._executor.submit(handler, timeout, topic, kwargs)
+
+    def _release_coalesced(self):
+        now = monotonic()
+        for coalescer in self._coalescers.values():
+            if coalescer.fire_at is None or coalescer.fire_at > now:
+                continue
+            handler, timeout = coalescer.handler, coalescer.timeout
+            pending = coalescer.take()
+            if coalescer.batch:
+                events = {"events": pending}
+                self._call_handler(handler, timeout, coalescer.pattern, events)
+            else:
+                for topic, kwargs in pending.items():
+                    self._call_handler(handler, timeout, topic, kwargs)
 
     def _topic_matches(self, pattern, topic):
-        self.log.debug("Matching topic '%s' against pattern '%s'", topic, pattern)
         # Simple pattern matching supporting * and ** wildcards
         p_parts = pattern.split(".")
         t_parts = topic.split(".")
@@ -194,25 +2441,37 @@ class Agent:
                 return False
         return len(p_parts) == len(t_parts)
 
+    def _run_handler(self, handler, timeout, *args, **kwargs):
+        failed = False
+        start_time = monotonic()
+        try:
+            handler(*args, **kwargs)
+            if monotonic() - start_time > timeout:
+                self.log.warning("Handler %s exceeded timeout", handler.__name__)
+        except Exception as e:
+            failed = True
+            self.log.error("Handler %s failed: %s", handler.__name__, str(e))
+            self._handle_error(e)
+        if self.metrics is not None:
+            self.metrics.record_handler(
+                handler.__name__, monotonic() - start_time, failed
+            )
+
     def _execute_handlers(self, handlers, *args):
-        for handler_tuple in handlers:
-            handler = handler_tuple[0]  # Get the handler function
-            timeout = handler_tuple[1]  # Get the timeout value
-            try:
-                start_time = time.time()
-                handler(*args)  # Execute the handler with any additional args
-                if time.time() - start_time > timeout:
-                    self.log.warning(f"Handler {handler.__name__} exceeded timeout")
-            except Exception as e:
-                self._handle_error(e)
+        for handler, timeout in handlers:
+            self._run_handler(handler, timeout, *args)
 
-    def _handle_error(self, error):
-        handled = False
+    def _matching_error_handlers(self, error):
         for handler, exc_type, message, timeout in self._error_handlers:
             if exc_type and not isinstance(error, exc_type):
                 continue
             if message and str(error) != message:
                 continue
+            yield handler, timeout
+
+    def _handle_error(self, error):
+        handled = False
+        for handler, timeout in self._matching_error_handlers(error):
             try:
                 start_time = time.time()
                 handler(error)
@@ -225,51 +2484,116 @@ class Agent:
             print(f"Unhandled error: {error}")
 
     def _check_intervals(self):
-        current_time = time.time()
-        for i, (handler, interval, timeout, last_run) in enumerate(
-            self._interval_handlers
-        ):
-            if current_time - last_run >= interval:
-                try:
-                    start_time = time.time()
-                    handler()
-                    if time.time() - start_time > timeout:
-                        print(f"Interval handler {handler.__name__} exceeded timeout")
-                except Exception as e:
-                    self._handle_error(e)
-                finally:
-                    # Update last run time
-                    self._interval_handlers[i] = (
-                        handler,
-                        interval,
-                        timeout,
-                        current_time,
-                    )
+        now = monotonic()
+        # Bounded so a zero interval can't keep this pass from returning
+        for _ in range(len(self._scheduler)):
+            task = self._scheduler.pop_due(now)
+            if task is None:
+                break
+            if self.metrics is not None:
+                self.metrics.interval_lag.add(now - task.fire_at)
+            self._run_interval(task, now)
+
+    def _run_interval(self, task, now):
+        self._run_handler(task.func, task.timeout)
+        self._scheduler.reschedule(task, monotonic())
+
+    def _wait_timeout(self):
+        """Seconds the loop may block before work is due"""
+        timeout = self.max_wait
+        if self._local:
+            return 0  # Hub deliveries waiting
+        if self._offline is not None and self.client and len(self._offline):
+            return 0  # Keep replaying the backlog
+        if self._inbox is not None and len(self._inbox):
+            return 0  # Messages still staged
+        due = self._scheduler.next_deadline()
+        if self._reconnect_at is not None:
+            due = self._reconnect_at if due is None else min(due, self._reconnect_at)
+        if self._inflight:
+            retry = next(iter(self._inflight.values()))[2] + self.qos_retry
+            due = retry if due is None else min(due, retry)
+        if self._deadlines:
+            expires = self._deadlines[0][0]
+            due = expires if due is None else min(due, expires)
+        for coalescer in self._coalescers.values():
+            if coalescer.fire_at is not None:
+                due = coalescer.fire_at if due is None else min(due, coalescer.fire_at)
+        if due is not None:
+            timeout = min(timeout, max(0, due - monotonic()))
+        return timeout
+
+    def _wait(self):
+        if self.loop_mode == "poll":
+            time.sleep(self.poll_interval)
+            return
+
+        timeout = self._wait_timeout()
+        sock = getattr(self.client, "sock", None) if self.client else None
+        if sock is None:
+            time.sleep(timeout)
+            return
+        if self._poller_sock is not sock:
+            self._poller = select.poll()
+            self._poller.register(sock, select.POLLIN)
+            self._poller_sock = sock
+        self._poller.poll(int(timeout * 1000))
 
     def connect(self):
+        if self.server is None:
+            return  # Only talks to agents on its LoopbackHub
+        self._reconnect_at = None
         try:
             self.log.info("Connecting to MQTT broker %s:%s", self.server, self.port)
-            self.client = MQTTClient(self.name, self.server, self.port)
-            self.client.set_callback(self._mqtt_callback)
-            self.client.connect()
+            client = self.client_factory(self.name, self.server, self.port)
+            client.set_callback(self._mqtt_callback)
+            clean = self.clean_session or not self._session_known
+            session_present = client.connect(clean_session=clean)
+            self._session_known = True
+            self.client = client  # Only once connected, emits buffer until then
             self.log.info("Connected successfully")
+            if self._reconnect_attempts and self.metrics is not None:
+                self.metrics.reconnects += 1
+            self._reconnect_attempts = 0
 
-            # Subscribe to all event topics
-            for topic in self._event_handlers:
-                mqtt_topic = self._to_mqtt_topic(topic)
-                self.log.debug("Subscribing to topic: %s (mqtt: %s)", topic, mqtt_topic)
-                try:
-                    self.client.subscribe(mqtt_topic.encode())
-                    self.log.info("Subscribed to: %s", topic)
-                except Exception as e:
-                    self.log.error("Failed to subscribe to %s: %s", topic, str(e))
+            # The broker kept our subscriptions if it resumed the session,
+            # then only patterns added since need subscribing
+            if not session_present:
+                self._subscriptions = []
+            self._subacks = {}
+            self._subscribe(self._event_handlers)
+            if self._inflight:
+                self._retry_inflight(resend_all=True)
 
             self._execute_handlers(self._connect_handlers)
         except Exception as e:
             self.log.error("Connection failed: %s", str(e))
             self._handle_error(e)
+            if self.client is None:
+                self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        delay = self.reconnect_min * 2**self._reconnect_attempts
+        delay = min(delay, self.reconnect_max)
+        delay = delay / 2 + random.random() * delay / 2
+        self._reconnect_attempts += 1
+        self._reconnect_at = monotonic() + delay
+        self.log.info("Reconnecting in %.1fs", delay)
+
+    def _connection_lost(self, error):
+        if self.client is None:
+            return
+        self.log.warning("Connection lost: %s", str(error))
+        try:
+            self.client.sock.close()
+        except Exception:
+            pass
+        self.client = None
+        self._execute_handlers(self._disconnect_handlers)
+        self._schedule_reconnect()
 
     def disconnect(self):
+        self._reconnect_at = None
         if self.client:
             try:
                 self.log.info("Disconnecting from MQTT broker")
@@ -279,26 +2603,296 @@ class Agent:
                 self.log.error("Disconnect failed: %s", str(e))
                 self._handle_error(e)
 
-    def run(self):
-        try:
-            self.log.info("Starting agent")
-            self.running = True
-            self._execute_handlers(self._start_handlers)
+    # Startup and shutdown wrap the lifecycle handlers in _starting/_started
+    # and _stopping/_stopped, so AsyncAgent can await those handlers in
+    # between and still share every other step.
+
+    def _startup(self):
+        self._starting()
+        self._execute_handlers(self._start_handlers)
+        self._started()
+
+    def _starting(self):
+        self.log.info("Starting agent")
+        self.running = True
+
+    def _started(self):
+        self.connect()
+
+    def _tick(self):
+        """One pass of the main loop, everything except waiting"""
+        if self.client:
+            try:
+                self._check_msg()
+                if self._inflight:
+                    self._retry_inflight()
+            except OSError as e:
+                self._connection_lost(e)
+        elif self._reconnect_at is not None and monotonic() >= self._reconnect_at:
             self.connect()
+        self._drain_local()
+        self._drain_inbox()
+        self._check_intervals()
+        if self._coalescers:
+            self._release_coalesced()
+        if self._deadlines:
+            self._expire_requests()
+        self._replay_offline()
+        self.flush()
+
+    def _shutdown(self):
+        self._stopping()
+        self._execute_handlers(self._stop_handlers)
+        self._stopped()
+
+    def _stopping(self):
+        self.log.info("Stopping agent")
+        if self._executor is not None:
+            self._executor.shutdown()
 
+    def _stopped(self):
+        self.flush()
+        self.disconnect()
+
+    def run(self):
+        try:
+            self._startup()
             while self.running:
-                if self.client:
-                    self.client.check_msg()
-                self._check_intervals()
-                time.sleep(0.1)
+                self._tick()
+                self._wait()
+
+        except Exception as e:
+            self.log.critical("Agent crashed: %s", str(e))
+            self._handle_error(e)
+        finally:
+            self._shutdown()
 
+    def run_once(self, drain=0.5, quiet=0.1, path=None):
+        """
+        One wake of a node that deep sleeps between wakes: restore the
+        interval schedule and session saved by the previous wake, connect,
+        run the intervals now due and publish their emits in one burst,
+        then handle inbound messages until none arrive for 'quiet' seconds
+        or 'drain' seconds pass, save state and disconnect. Returns the
+        milliseconds until the next interval is due, for
+        machine.deepsleep(), or None without intervals. State lives in
+        RTC memory, or in file 'path' on ports without it.
+        """
+        store = SleepState(path)
+        self._restore_sleep_state(store.load())
+        batching = self._outbox is None
+        if batching:
+            self._outbox = Outbox()  # Due intervals' emits go out together
+        try:
+            self._startup()
+            self._check_intervals()
+            self.flush()
+            deadline = monotonic() + drain
+            while self.running:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                received = self._received
+                self._tick()
+                if self._received != received or self._wait_timeout() == 0:
+                    continue
+                waiting = self._inflight or self._subacks  # Acks still due
+                if not self._readable(min(quiet, remaining)) and not waiting:
+                    break
         except Exception as e:
             self.log.critical("Agent crashed: %s", str(e))
             self._handle_error(e)
         finally:
-            self.log.info("Stopping agent")
-            self._execute_handlers(self._stop_handlers)
-            self.disconnect()
+            self._shutdown()
+            self.running = False
+            if batching:
+                self._outbox = None
+            store.save(self._sleep_state())
+        due = self._scheduler.next_deadline()
+        if due is None:
+            return None
+        return int(max(0, due - monotonic()) * 1000)
+
+    def _readable(self, timeout):
+        """Wait up to 'timeout' seconds for the broker socket to be readable"""
+        sock = getattr(self.client, "sock", None) if self.client else None
+        if sock is None:
+            return False
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        return bool(poller.poll(int(timeout * 1000)))
+
+    def _sleep_state(self):
+        # Deep sleep resets the monotonic clock, so deadlines are saved
+        # as wall-clock times
+        now, wall = monotonic(), time.time()
+        return {
+            "due": [wall + task.due - now for task in self._scheduler.tasks],
+            "subscriptions": self._subscriptions,
+            "pid": self._next_pid,
+            "reply": self._reply_topic,
+        }
+
+    def _restore_sleep_state(self, state):
+        dues = state.get("due", ())
+        if len(dues) == len(self._scheduler.tasks):
+            now, wall = monotonic(), time.time()
+            self._scheduler.restore([now + due - wall for due in dues])
+        self._subscriptions = state.get("subscriptions", [])
+        self._next_pid = state.get("pid", 0)
+        self._session_known = "subscriptions" in state
+        if state.get("reply") and self._reply_topic is None:
+            # Reuse the reply topic subscribed by an earlier wake
+            self._reply_topic = state["reply"]
+            self._add_pattern(self._reply_topic)
 
     def stop(self):
         self.running = False
+
+
+class AsyncAgent(Agent):
+    """
+    Agent running on asyncio (uasyncio on MicroPython).
+    Handlers may be plain functions or coroutine functions. Each handler
+    call runs in its own task, so slow I/O-bound handlers overlap instead
+    of blocking the message loop, and coroutine handlers are cancelled
+    once they exceed their timeout. With loop_mode="select" the loop
+    awaits the MQTT socket instead of polling, where the event loop can
+    watch sockets (asyncio's add_reader).
+    """
+
+    def __init__(
+        self, name, server="localhost", port=1883, log_level="INFO", loop_mode="poll"
+    ):
+        super().__init__(name, server, port, log_level, loop_mode)
+        self._tasks = []
+
+    def _spawn(self, coro):
+        task = _import_asyncio().create_task(coro)
+        self._tasks.append(task)
+        return task
+
+    async def _call(self, handler, timeout, args, kwargs):
+        asyncio = _import_asyncio()
+        failed = False
+        start_time = monotonic()
+        try:
+            result = handler(*args, **kwargs)
+            if hasattr(result, "send"):  # Coroutine (generator on MicroPython)
+                await asyncio.wait_for(result, timeout)
+            elif monotonic() - start_time > timeout:
+                self.log.warning("Handler %s exceeded timeout", handler.__name__)
+        except asyncio.TimeoutError:
+            failed = True
+            msg = "Handler %s cancelled after %ss timeout" % (handler.__name__, timeout)
+            self.log.warning(msg)
+            self._handle_error(asyncio.TimeoutError(msg))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            failed = True
+            self.log.error("Handler %s failed: %s", handler.__name__, str(e))
+            self._handle_error(e)
+        if self.metrics is not None:
+            self.metrics.record_handler(
+                handler.__name__, monotonic() - start_time, failed
+            )
+
+    def _run_handler(self, handler, timeout, *args, **kwargs):
+        self._spawn(self._call(handler, timeout, args, kwargs))
+
+    def _run_interval(self, task, now):
+        if task.mode == "rate":
+            self._scheduler.reschedule(task, now)
+            self._run_handler(task.func, task.timeout)
+        else:
+            self._spawn(self._call_interval(task))
+
+    async def _call_interval(self, task):
+        try:
+            await self._call(task.func, task.timeout, (), {})
+        finally:
+            self._scheduler.reschedule(task, monotonic())
+
+    async def _run_handlers(self, handlers, *args):
+        # Lifecycle handlers run in order, each one awaited
+        for handler, timeout in handlers:
+            await self._call(handler, timeout, args, {})
+
+    def _handle_error(self, error):
+        handled = False
+        for handler, timeout in self._matching_error_handlers(error):
+            self._spawn(self._call_error_handler(handler, timeout, error))
+            handled = True
+        if not handled:
+            print(f"Unhandled error: {error}")
+
+    async def _call_error_handler(self, handler, timeout, error):
+        asyncio = _import_asyncio()
+        try:
+            result = handler(error)
+            if hasattr(result, "send"):
+                await asyncio.wait_for(result, timeout)
+        except asyncio.TimeoutError:
+            print(f"Error handler {handler.__name__} exceeded timeout")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Error in error handler: {e}")
+
+    async def run_async(self):
+        asyncio = _import_asyncio()
+        try:
+            await self._startup_async()
+            while self.running:
+                self._tick()
+                self._tasks = [task for task in self._tasks if not task.done()]
+                await self._wait_async()
+
+        except Exception as e:
+            self.log.critical("Agent crashed: %s", str(e))
+            self._handle_error(e)
+        finally:
+            await self._shutdown_async()
+
+    async def _wait_async(self):
+        asyncio = _import_asyncio()
+        if self.loop_mode == "poll":
+            await asyncio.sleep(self.poll_interval)
+            return
+
+        timeout = self._wait_timeout()
+        sock = getattr(self.client, "sock", None) if self.client else None
+        loop = asyncio.get_event_loop()
+        if sock is None or not timeout or not hasattr(loop, "add_reader"):
+            # Can't watch the socket, poll it
+            await asyncio.sleep(min(timeout, self.poll_interval) if sock else timeout)
+            return
+        ready = loop.create_future()
+        fd = sock.fileno()
+        loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await asyncio.wait_for(ready, timeout)
+        except asyncio.TimeoutError:
+            pass  # Something is due
+        finally:
+            loop.remove_reader(fd)
+
+    async def _startup_async(self):
+        self._starting()
+        await self._run_handlers(self._start_handlers)
+        self._started()
+
+    async def _shutdown_async(self):
+        self._stopping()
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        await self._run_handlers(self._stop_handlers)
+        self._stopped()
+        # Let disconnect handlers spawned above finish
+        for task in self._tasks:
+            await task
+
+    def run(self):
+        _import_asyncio().run(self.run_async())
@@ -0,0 +1,335 @@
+"""
+Parts of uagent that need a full Python host such as CPython on Linux.
+They live outside uagent.py so MicroPython boards don't compile them.
+"""
+import select
+import time
+from collections import OrderedDict
+
+from uagent import IntervalTask, TopicIndex, monotonic
+
+
+class HandlerExecutor:
+    """
+    Runs event handlers on a concurrent.futures pool (CPython only).
+    Messages for the same handler and topic run one after another in
+    arrival order, and at most 'max_concurrency' topics of one handler
+    run at once. Handlers can't be interrupted, so runs longer than the
+    handler timeout are logged and counted in 'overruns'.
+
+    kind="process" runs handlers in worker processes; they must be
+    picklable module-level functions and their emits stay in the worker.
+    """
+
+    def __init__(self, agent, max_workers=4, kind="thread"):
+        import threading
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+        if kind not in ("thread", "process"):
+            raise ValueError("Unknown executor kind: %s" % kind)
+        self.agent = agent
+        self.overruns = {}  # handler name -> count
+        self._threads = ThreadPoolExecutor(max_workers)
+        self._processes = None
+        if kind == "process":
+            self._processes = ProcessPoolExecutor(max_workers)
+        self._lock = threading.Lock()
+        self._queues = {}  # (handler, timeout, topic) -> [payload, ...]
+        self._active = {}  # handler -> number of topics running
+        self._waiting = {}  # handler -> [key, ...] waiting for a free slot
+
+    def submit(self, handler, timeout, topic, payload):
+        key = (handler, timeout, topic)
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is not None:
+                queue.append(payload)  # Runs after the earlier messages
+                return
+            self._queues[key] = [payload]
+            limit = self.agent._concurrency.get(handler)
+            if limit is not None and self._active.get(handler, 0) >= limit:
+                self._waiting.setdefault(handler, []).append(key)
+                return
+            self._active[handler] = self._active.get(handler, 0) + 1
+        self._threads.submit(self._drain, key)
+
+    def _drain(self, key):
+        handler, timeout, topic = key
+        while True:
+            with self._lock:
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    waiting = self._waiting.get(handler)
+                    if not waiting:
+                        self._active[handler] -= 1
+                        return
+                    key = waiting.pop(0)  # Hand this slot to a waiting topic
+                    handler, timeout, topic = key
+                    continue
+                payload = queue.pop(0)
+            self._call(handler, timeout, payload)
+
+    def _call(self, handler, timeout, payload):
+        agent = self.agent
+        failed = False
+        start_time = monotonic()
+        try:
+            if self._processes is None:
+                handler(**payload)
+            else:
+                self._processes.submit(handler, **payload).result()
+            if monotonic() - start_time > timeout:
+                name = handler.__name__
+                with self._lock:
+                    self.overruns[name] = self.overruns.get(name, 0) + 1
+                agent.log.warning("Handler %s exceeded timeout", name)
+        except Exception as e:
+            failed = True
+            agent.log.error("Handler %s failed: %s", handler.__name__, str(e))
+            agent._handle_error(e)
+        if agent.metrics is not None:
+            with self._lock:
+                agent.metrics.record_handler(
+                    handler.__name__, monotonic() - start_time, failed
+                )
+
+    def shutdown(self):
+        self._threads.shutdown(wait=True)
+        if self._processes is not None:
+            self._processes.shutdown(wait=True)
+
+
+class LoopbackHub:
+    """
+    Delivers events between agents in the same process without a broker
+    round trip or serialization. Agents attached to the hub hand each
+    emit's kwargs straight to every attached agent with a matching
+    on_event pattern. Topics matching a 'local' pattern stop there; the
+    rest are also published to the broker for remote agents, and their
+    broker echo is dropped for agents that already got them locally.
+
+    hub.run() drives all attached agents from a single loop.
+    """
+
+    def __init__(self, local=(), max_echoes=256):
+        self.agents = []
+        self.running = False
+        self.max_echoes = max_echoes
+        self._local_index = TopicIndex()
+        for pattern in local:
+            self._local_index.add(pattern)
+        self._echoes = OrderedDict()  # (agent id, mqtt topic, payload) -> count
+        self._poller = None
+        self._poller_socks = ()
+
+    def attach(self, agent):
+        self.agents.append(agent)
+        agent._hub = self
+        return agent
+
+    def deliver(self, topic, payload):
+        """Queue payload for attached agents, return (local_only, recipients)"""
+        recipients = []
+        for agent in self.agents:
+            if agent._topic_index.match(topic):
+                agent._local.append((topic, payload))
+                recipients.append(agent)
+        return bool(self._local_index.match(topic)), recipients
+
+    def expect_echo(self, recipients, mqtt_topic, payload):
+        echoes = self._echoes
+        for agent in recipients:
+            if not agent.client:
+                continue  # Not on the broker, no echo will come
+            key = (id(agent), mqtt_topic, payload)
+            count = echoes.pop(key, 0)
+            if len(echoes) >= self.max_echoes:
+                del echoes[next(iter(echoes))]
+            echoes[key] = count + 1
+
+    def is_echo(self, agent, mqtt_topic, msg):
+        key = (id(agent), mqtt_topic, msg)
+        count = self._echoes.get(key)
+        if count is None:
+            return False
+        if count > 1:
+            self._echoes[key] = count - 1
+        else:
+            del self._echoes[key]
+        return True
+
+    def run(self):
+        self.running = True
+        try:
+            for agent in self.agents:
+                agent._startup()
+            while self.running and any(agent.running for agent in self.agents):
+                for agent in self.agents:
+                    if not agent.running:
+                        continue
+                    try:
+                        agent._tick()
+                    except Exception as e:
+                        agent.log.critical("Agent crashed: %s", str(e))
+                        agent._handle_error(e)
+                        agent.stop()
+                self._wait()
+        finally:
+            for agent in self.agents:
+                agent._shutdown()
+
+    def stop(self):
+        self.running = False
+
+    def _wait(self):
+        timeout = min(agent._wait_timeout() for agent in self.agents)
+        socks = []
+        for agent in self.agents:
+            sock = getattr(agent.client, "sock", None) if agent.client else None
+            if sock is not None:
+                socks.append(sock)
+        if not socks:
+            time.sleep(timeout)
+            return
+        socks = tuple(socks)
+        if socks != self._poller_socks:
+            self._poller = select.poll()
+            for sock in socks:
+                self._poller.register(sock, select.POLLIN)
+            self._poller_socks = socks
+        self._poller.poll(int(timeout * 1000))
+
+
+def _merge_metrics(total, snapshot):
+    """Sum two metrics snapshots, e.g. from the workers of an AgentGroup"""
+    if isinstance(total, dict):
+        merged = dict(total)
+        for key, value in snapshot.items():
+            if key not in total:
+                merged[key] = value
+            elif key == "uptime":
+                merged[key] = max(total[key], value)
+            elif key != "bounds_ms":
+                merged[key] = _merge_metrics(total[key], value)
+        return merged
+    if isinstance(total, list):
+        return [a + b for a, b in zip(total, snapshot)]
+    return total + snapshot
+
+
+class AgentGroup:
+    """
+    Runs 'workers' copies of a configured agent in forked processes, to
+    use more than one core (CPython on Linux only). Workers subscribe
+    through MQTT shared subscriptions ($share/<group>/...), so the broker
+    spreads messages across them. Patterns in 'affinity' are instead
+    subscribed by every worker and partitioned by key, so stateful
+    handlers see all messages of a key: 'affinity' maps each pattern to
+    a function of the topic returning the key, or None to key on the
+    topic itself. Affine patterns shouldn't overlap the other patterns.
+
+    Every worker runs the on_start handlers, then waits for the others
+    before connecting; group.stop() stops them all, each running its
+    on_stop handlers. group.metrics_snapshot() sums the workers' metrics.
+    """
+
+    def __init__(self, agent, workers=2, group=None, affinity=None):
+        import multiprocessing
+
+        self.agent = agent
+        self.workers = workers
+        self.group = group or agent.name
+        self.affinity = affinity or {}
+        self.start_timeout = 30  # Seconds to wait for all workers to start
+        self.report_interval = 1.0  # Seconds between worker metrics reports
+        self._context = multiprocessing.get_context("fork")
+        self._barrier = self._context.Barrier(workers)
+        self._stopping = self._context.Event()
+        self._reports = self._context.Queue()
+        self._snapshots = {}  # worker index -> latest metrics snapshot
+        self._processes = []
+
+    def start(self):
+        for index in range(self.workers):
+            name = "%s-%d" % (self.agent.name, index)
+            process = self._context.Process(
+                target=self._worker_main, args=(index,), name=name
+            )
+            process.start()
+            self._processes.append(process)
+
+    def run(self):
+        """Start the workers and wait for them, until stop() or Ctrl-C"""
+        self.start()
+        try:
+            while not self._stopping.is_set():
+                if not any(p.is_alive() for p in self._processes):
+                    break
+                self._drain_reports()
+                self._stopping.wait(0.2)
+        except KeyboardInterrupt:
+            pass
+        self.stop()
+
+    def stop(self, timeout=10):
+        """Stop the workers, terminating those still running after 'timeout'"""
+        self._stopping.set()
+        deadline = monotonic() + timeout
+        for process in self._processes:
+            # A worker only exits once its queued reports are read
+            while process.is_alive() and monotonic() < deadline:
+                self._drain_reports()
+                process.join(0.1)
+            if process.is_alive():
+                process.terminate()
+                process.join(1)
+        self._drain_reports()
+
+    def _drain_reports(self):
+        """Keep the latest snapshot of each worker, emptying the queue"""
+        import queue
+
+        while True:
+            try:
+                index, snapshot = self._reports.get_nowait()
+            except queue.Empty:
+                return
+            self._snapshots[index] = snapshot
+
+    def metrics_snapshot(self):
+        """Sum of the latest metrics snapshot of every worker"""
+        self._drain_reports()
+        total = None
+        for snapshot in self._snapshots.values():
+            total = snapshot if total is None else _merge_metrics(total, snapshot)
+        if total is not None:
+            total["workers"] = len(self._snapshots)
+        return total
+
+    def _worker_main(self, index):
+        agent = self.agent
+        agent._join_group(self.group, index, self.workers, self.affinity)
+        if agent.metrics is None:
+            agent.enable_metrics()
+
+        def ready():
+            self._barrier.wait(self.start_timeout)
+
+        def check_stop():
+            if self._stopping.is_set():
+                agent.stop()
+
+        def report():
+            self._reports.put((index, agent.metrics_snapshot()))
+
+        agent._start_handlers.append((ready, self.start_timeout))
+        agent._stop_handlers.append((report, 1))
+        agent._scheduler.add(IntervalTask(check_stop, 0.2, 0.2))
+        agent._scheduler.add(
+            IntervalTask(report, self.report_interval, self.report_interval)
+        )
+        try:
+            agent.run()
+        except KeyboardInterrupt:
+            pass  # Ctrl-C reaches every worker, run() already shut down